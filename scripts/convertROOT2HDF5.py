@@ -1,245 +1,763 @@
-from ROOT import TFile
-from math import atan2, atan, acos, asin, sqrt, sin, cos, tan, floor, ceil
 import numpy as np
 import h5py
-import sys
-
-if len(sys.argv) > 1:
-    arg1 = sys.argv[1]
-    print(f"Input ROOT file: {arg1}")
-else:
-    sys.exit("No input ROOT file specified.")
-
-def getsystem(cellID):
-    return cellID & 0b1111   # system last 4 bits
-
-def geteta(cellID):
-    return (cellID>>4) & 0b11111111111    # eta preceding 11 bits
-
-def getphi(cellID):
-    return (cellID>>15) & 0b11111111111     # phi preceding 11 bits
-
-def getdepth(cellID):
-    return (cellID>>26) & 0b1111            # depth preceding 4 bits
-
-
-class MCParticle():
-    def __init__(self, mcp):
-        self.PDG                = mcp.PDG
-        self.generatorStatus    = mcp.generatorStatus
-        self.simulatorStatus    = mcp.simulatorStatus
-        self.charge             = mcp.charge
-        self.time               = mcp.time
-        self.mass               = mcp.mass
-        self.vx                 = mcp.vertex.x
-        self.vy                 = mcp.vertex.y
-        self.vz                 = mcp.vertex.z
-        self.endx               = mcp.endpoint.x
-        self.endy               = mcp.endpoint.y
-        self.endz               = mcp.endpoint.z
-        self.px                 = mcp.momentum.x
-        self.py                 = mcp.momentum.y
-        self.pz                 = mcp.momentum.z
-        self.endpx              = mcp.momentumAtEndpoint.x
-        self.endpy              = mcp.momentumAtEndpoint.y
-        self.endpz              = mcp.momentumAtEndpoint.z
-        self.spinx              = mcp.spin.x
-        self.spiny              = mcp.spin.y
-        self.spinz              = mcp.spin.z
-        self.colorFlowa         = mcp.colorFlow.a
-        self.colorFlowb         = mcp.colorFlow.b
-        self.energy             = sqrt(self.px*self.px +self.py*self.py +self.pz*self.pz +self.mass*self.mass)
-
-class MCCollection():
-    def __init__(self, mcplist):
-        self.particles           = np.array(mcplist)
-        self.N                   = len(mcplist)
-        self.PDG                 = np.array([mcp.PDG                 for mcp in self.particles])
-        self.generatorStatus     = np.array([mcp.generatorStatus     for mcp in self.particles])
-        self.simulatorStatus     = np.array([mcp.simulatorStatus     for mcp in self.particles])
-        self.charge              = np.array([mcp.charge              for mcp in self.particles])
-        self.time                = np.array([mcp.time                for mcp in self.particles])
-        self.mass                = np.array([mcp.mass                for mcp in self.particles])
-        self.vx                  = np.array([mcp.vx                  for mcp in self.particles])
-        self.vy                  = np.array([mcp.vy                  for mcp in self.particles])
-        self.vz                  = np.array([mcp.vz                  for mcp in self.particles])
-        self.endx                = np.array([mcp.endx                for mcp in self.particles])
-        self.endy                = np.array([mcp.endy                for mcp in self.particles])
-        self.endz                = np.array([mcp.endz                for mcp in self.particles])
-        self.px                  = np.array([mcp.px                  for mcp in self.particles])
-        self.py                  = np.array([mcp.py                  for mcp in self.particles])
-        self.pz                  = np.array([mcp.pz                  for mcp in self.particles])
-        self.endpx               = np.array([mcp.endpx               for mcp in self.particles])
-        self.endpy               = np.array([mcp.endpy               for mcp in self.particles])
-        self.endpz               = np.array([mcp.endpz               for mcp in self.particles])
-        self.spinx               = np.array([mcp.spinx               for mcp in self.particles])
-        self.spiny               = np.array([mcp.spiny               for mcp in self.particles])
-        self.spinz               = np.array([mcp.spinz               for mcp in self.particles])
-        self.colorFlowa          = np.array([mcp.colorFlowa          for mcp in self.particles])
-        self.colorFlowb          = np.array([mcp.colorFlowb          for mcp in self.particles])
-        self.energy              = np.array([mcp.energy              for mcp in self.particles])
-    def __iter__(self):
-        for mcp in self.particles:
-            yield mcp
-
-class RawHit():
-    # Takes edm4hep SimCalorimeterDRHit
-    def __init__(self, hit):
-        self.cellID           = hit.cellID
-        self.E                = hit.energy
-        self.x                = hit.position.x
-        self.y                = hit.position.y
-        self.z                = hit.position.z
-
-        # convert from readout bits
-        self.system           = getsystem(self.cellID)
-        self.neta             = geteta(self.cellID)
-        self.nphi             = getphi(self.cellID)
-        self.ndepth           = getdepth(self.cellID)
-
-        self.ncerenkovprod      = hit.nCerenkovProd
-        self.nscintillationprod = hit.nScintillationProd
-        self.tavgc              = hit.tAvgC
-        self.tavgs              = hit.tAvgS
-
-        self.r                = sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
-        self.theta            = acos(self.z / self.r) if self.r != 0 else 0
-        self.phi              = atan2(self.y, self.x)
-        # self.contribs = hit.contributions  # one-to-many relations not implemented in python classes
-
-class HitCollection():
-    # Takes python array of RawHit
-    def __init__(self, rawhits):
-        self.hits                = np.array(rawhits)
-        self.N                   = len(rawhits)
-        self.cellID              = np.array([hit.cellID              for hit in self.hits])
-        self.E                   = np.array([hit.E                   for hit in self.hits])
-        self.x                   = np.array([hit.x                   for hit in self.hits])
-        self.y                   = np.array([hit.y                   for hit in self.hits])
-        self.z                   = np.array([hit.z                   for hit in self.hits])
-        self.system              = np.array([hit.system              for hit in self.hits])
-        self.neta                = np.array([hit.neta                for hit in self.hits])
-        self.nphi                = np.array([hit.nphi                for hit in self.hits])
-        self.ndepth              = np.array([hit.ndepth              for hit in self.hits])
-        self.ncerenkovprod       = np.array([hit.ncerenkovprod       for hit in self.hits])
-        self.nscintillationprod  = np.array([hit.nscintillationprod  for hit in self.hits])
-        self.tavgc               = np.array([hit.tavgc               for hit in self.hits])
-        self.tavgs               = np.array([hit.tavgs               for hit in self.hits])
-        self.r                = np.array([hit.r                      for hit in self.hits])
-        self.theta            = np.array([hit.theta                  for hit in self.hits])
-        self.phi              = np.array([hit.phi                    for hit in self.hits])
-    def __iter__(self):
-        for hit in self.hits:
-            yield hit
-
-
-def getHitsForAllEvents(fname):
-    f = TFile.Open(fname)
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import uproot
+    import awkward as ak
+except ImportError:
+    uproot = None
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from scepcal_utils import LAYOUT_VERSION, HIT_ATTRS, MC_ATTRS, SUMMARY_ATTRS, DERIVED_HIT_SOURCES
+from scepcal_utils import CellIDDecoder, DEFAULT_DECODER, CELLID_FIELD_ATTRS
+from scepcal_utils import MCParticle, MCCollection, RawHit, HitCollection
+from scepcal_utils import iter_chunks_from_hdf5, iter_chunks_from_parquet, compute_event_summary, derive_hit_columns
+from scepcal_utils import expand_files
+
+DEFAULT_CHUNK_EVENTS = 100
+
+# hdf5 chunk shapes (in elements) of the per-hit, per-particle and per-event datasets
+HIT_CHUNK   = 65536
+MC_CHUNK    = 16384
+EVENT_CHUNK = 4096
+
+# events per parquet row group
+ROW_GROUP_EVENTS = 1000
+
+# elements copied at a time when repacking into contiguous datasets
+COPY_BLOCK = 1 << 22
+
+# Column codecs are 'none', 'gzip[:level]', 'lzf' and, with hdf5plugin installed, 'lz4', 'zstd[:level]',
+# 'blosc-lz4[:level]' and 'blosc-zstd[:level]'. Keys are a group name or 'group/field' for a single column.
+DEFAULT_CODECS = {
+    'HitCollection': 'gzip:4',
+    'MCCollection':  'none',
+    'EventSummary':  'none',
+}
+PLUGIN_CODECS = ('lz4', 'zstd', 'blosc-lz4', 'blosc-zstd')
+# allowed compression levels of the codecs that take one
+CODEC_LEVELS = {
+    'gzip':       (0, 9),
+    'zstd':       (1, 22),
+    'blosc-lz4':  (0, 9),
+    'blosc-zstd': (0, 9),
+}
+
+# edm4hep/edm4dr branch leaves read by the columnar reader, keyed by output field
+HIT_BRANCHES = {
+    'cellID':             'cellID',
+    'E':                  'energy',
+    'x':                  'position.x',
+    'y':                  'position.y',
+    'z':                  'position.z',
+    'ncerenkovprod':      'nCerenkovProd',
+    'nscintillationprod': 'nScintillationProd',
+    'tavgc':              'tAvgC',
+    'tavgs':              'tAvgS',
+}
 
-    SDhitsForEvent = {}
-    MCParticlesForEvent = {}
+MC_BRANCHES = {
+    'PDG':             'PDG',
+    'generatorStatus': 'generatorStatus',
+    'simulatorStatus': 'simulatorStatus',
+    'charge':          'charge',
+    'time':            'time',
+    'mass':            'mass',
+    'vx':              'vertex.x',
+    'vy':              'vertex.y',
+    'vz':              'vertex.z',
+    'endx':            'endpoint.x',
+    'endy':            'endpoint.y',
+    'endz':            'endpoint.z',
+    'px':              'momentum.x',
+    'py':              'momentum.y',
+    'pz':              'momentum.z',
+    'endpx':           'momentumAtEndpoint.x',
+    'endpy':           'momentumAtEndpoint.y',
+    'endpz':           'momentumAtEndpoint.z',
+    'spinx':           'spin.x',
+    'spiny':           'spin.y',
+    'spinz':           'spin.z',
+    'colorFlowa':      'colorFlow.a',
+    'colorFlowb':      'colorFlow.b',
+}
 
+def _event_offsets(counts):
+    offsets = np.zeros(len(counts)+1, dtype='int64')
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def _concat_attr(collections, attr, dtype):
+    arrays = [np.asarray(getattr(coll, attr), dtype=dtype) for coll in collections if coll is not None and coll.N > 0]
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+def _chunk_from_collections(event_numbers, hcs, mccolls, decoder):
+    # A chunk holds the columns of a run of consecutive events, delimited by chunk-local offsets
+    hits = {attr: _concat_attr(hcs, attr, dtype) for attr, dtype in HIT_ATTRS.items()}
+    if decoder is not DEFAULT_DECODER:
+        _decode_cellID_columns(hits, decoder)
+    return {
+        'event_numbers': np.array(event_numbers, dtype='int64'),
+        'hit_offsets':   _event_offsets([hc.N if hc is not None else 0 for hc in hcs]),
+        'hits':          hits,
+        'mc_offsets':    _event_offsets([mccoll.N if mccoll is not None else 0 for mccoll in mccolls]),
+        'mc':            {attr: _concat_attr(mccolls, attr, dtype) for attr, dtype in MC_ATTRS.items()},
+    }
+
+def iter_event_chunks_pyroot(fname, chunk_events=DEFAULT_CHUNK_EVENTS, decoder=DEFAULT_DECODER):
+    # Reference reader: one python object per hit and per particle through PyROOT
+    from ROOT import TFile
+    f = TFile.Open(fname)
+
+    event_numbers, hcs, mccolls = [], [], []
     for i, event in enumerate(f.events):
         SDhitlayer  = event.SCEPCal_readout
         MClayer     = event.MCParticles
 
-        SDhitsForEvent[i]      = HitCollection([RawHit(hit) for hit in SDhitlayer]) if SDhitlayer else None
-        MCParticlesForEvent[i] = MCCollection([MCParticle(mcp) for mcp in MClayer])
-
-    return SDhitsForEvent, MCParticlesForEvent
-
-def save_allevents_to_hdf5(SDhits_allevents, MCP_allevents, filename):
-    with h5py.File(filename, 'w') as f:
-        events_grp = f.create_group('Events')
-        event_numbers = sorted(SDhits_allevents.keys())
-        print(f'Events: {event_numbers}')
-        for event_num in event_numbers:
-            event_grp = events_grp.create_group(f'Event_{event_num}')
-            hc = SDhits_allevents[event_num]
-
-            print(f'HitCollection.N: {hc.N}')
-            mccoll = MCP_allevents.get(event_num, None)
-            if mccoll is None:
-                print(f"Warning: No MCCollection found for event {event_num}")
-                continue
-            
-            hits_grp = event_grp.create_group('HitCollection')
-            
-            hit_attrs = {
-                'cellID': 'uint64',
-                'E': 'float32',
-                'x': 'float32',
-                'y': 'float32',
-                'z': 'float32',
-                'system': 'int32',
-                'neta': 'int32',
-                'nphi': 'int32',
-                'ndepth': 'int32',
-                'ncerenkovprod': 'int32',
-                'nscintillationprod': 'int32',
-                'tavgc': 'float32',
-                'tavgs': 'float32',
-                'r': 'float32',
-                'theta': 'float32',
-                'phi': 'float32'
-            }
-                    
-            for attr, dtype in hit_attrs.items():
-                data = getattr(hc, attr)
-                hits_grp.create_dataset(attr, data=data, dtype=dtype, compression="gzip", compression_opts=4)
-            
-            mc_grp = event_grp.create_group('MCCollection')
-            
-            mc_attrs = {
-                'PDG': 'int32',
-                'generatorStatus': 'int32',
-                'simulatorStatus': 'int32',
-                'charge': 'float32',
-                'time': 'float32',
-                'mass': 'float64',
-                'vx': 'float64',
-                'vy': 'float64',
-                'vz': 'float64',
-                'endx': 'float64',
-                'endy': 'float64',
-                'endz': 'float64',
-                'px': 'float32',
-                'py': 'float32',
-                'pz': 'float32',
-                'endpx': 'float32',
-                'endpy': 'float32',
-                'endpz': 'float32',
-                'spinx': 'float32',
-                'spiny': 'float32',
-                'spinz': 'float32',
-                'colorFlowa': 'int32',
-                'colorFlowb': 'int32'
-            }
-            
-            spin_array = np.array([ [mcp.spinx, mcp.spiny, mcp.spinz] for mcp in mccoll.particles ], dtype='float32')
-            colorFlow_array = np.array([ [mcp.colorFlowa, mcp.colorFlowb] for mcp in mccoll.particles ], dtype='int32')
-            
-            for attr, dtype in mc_attrs.items():
-                if attr.startswith('spin'):
-                    component = attr[4]  # 'x', 'y', or 'z'
-                    index = {'x': 0, 'y': 1, 'z': 2}[component]
-                    data = spin_array[:, index]
-                    mc_grp.create_dataset(attr, data=data, dtype=dtype)
-                elif attr.startswith('colorFlow'):
-                    component = attr[9]  # 'a' or 'b'
-                    index = {'a': 0, 'b': 1}[component]
-                    data = colorFlow_array[:, index]
-                    mc_grp.create_dataset(attr, data=data, dtype=dtype)
-                else:
-                    data = getattr(mccoll, attr)
-                    mc_grp.create_dataset(attr, data=data, dtype=dtype)
-            
-        f.attrs['N_Events'] = len(event_numbers)
-    
-    print(f"All events successfully saved to {filename}")
-
-inputROOT = sys.argv[1]
-
-SDhits_allevents, MCP_allevents = getHitsForAllEvents(inputROOT)
-
-save_allevents_to_hdf5(SDhits_allevents, MCP_allevents, f'{inputROOT[:-5]}.hdf5')
\ No newline at end of file
+        event_numbers.append(i)
+        hcs.append(HitCollection([RawHit(hit) for hit in SDhitlayer]) if SDhitlayer else None)
+        mccolls.append(MCCollection([MCParticle(mcp) for mcp in MClayer]))
+
+        if len(event_numbers) == chunk_events:
+            yield _chunk_from_collections(event_numbers, hcs, mccolls, decoder)
+            event_numbers, hcs, mccolls = [], [], []
+
+    if event_numbers:
+        yield _chunk_from_collections(event_numbers, hcs, mccolls, decoder)
+
+    f.Close()
+
+def _flatten_branches(arrays, collection, branches, attrs):
+    columns = {}
+    counts  = None
+    for attr, leaf in branches.items():
+        jagged = arrays[f'{collection}/{collection}.{leaf}']
+        if counts is None:
+            counts = ak.to_numpy(ak.num(jagged))
+        columns[attr] = ak.to_numpy(ak.flatten(jagged)).astype(attrs[attr], copy=False)
+    return _event_offsets(counts), columns
+
+def _decode_cellID_columns(hits, decoder):
+    hits.update(derive_hit_columns(hits, CELLID_FIELD_ATTRS.values(), decoder))
+
+def _derived_hit_columns(hits, decoder):
+    hits.update(derive_hit_columns(hits, DERIVED_HIT_SOURCES, decoder))
+
+def iter_event_chunks_uproot(fname, chunk_events=DEFAULT_CHUNK_EVENTS, decoder=DEFAULT_DECODER):
+    # Columnar reader: whole branches per chunk as flat numpy arrays, no python object per hit
+    tree = uproot.open(fname)['events']
+    expressions  = [f'SCEPCal_readout/SCEPCal_readout.{leaf}' for leaf in HIT_BRANCHES.values()]
+    expressions += [f'MCParticles/MCParticles.{leaf}' for leaf in MC_BRANCHES.values()]
+
+    for arrays, report in tree.iterate(expressions, step_size=chunk_events, library='ak', report=True):
+        hit_offsets, hits = _flatten_branches(arrays, 'SCEPCal_readout', HIT_BRANCHES, HIT_ATTRS)
+        mc_offsets, mc    = _flatten_branches(arrays, 'MCParticles', MC_BRANCHES, MC_ATTRS)
+        _derived_hit_columns(hits, decoder)
+        yield {
+            'event_numbers': np.arange(report.tree_entry_start, report.tree_entry_stop, dtype='int64'),
+            'hit_offsets':   hit_offsets,
+            'hits':          {attr: hits[attr] for attr in HIT_ATTRS},
+            'mc_offsets':    mc_offsets,
+            'mc':            mc,
+        }
+
+READERS = {
+    'uproot': iter_event_chunks_uproot,
+    'pyroot': iter_event_chunks_pyroot,
+}
+
+def iter_event_chunks(fname, chunk_events=DEFAULT_CHUNK_EVENTS, reader='auto', decoder=DEFAULT_DECODER):
+    if reader == 'auto':
+        reader = 'uproot' if uproot is not None else 'pyroot'
+    if reader == 'uproot' and uproot is None:
+        raise ImportError("The uproot reader needs the uproot and awkward packages.")
+    return READERS[reader](fname, chunk_events, decoder)
+
+def benchmark_readers(fname, chunk_events=DEFAULT_CHUNK_EVENTS, max_events=None, decoder=DEFAULT_DECODER):
+    # Decoding throughput of each available reader, without writing anything
+    readers = ['pyroot'] + (['uproot'] if uproot is not None else [])
+    for reader in readers:
+        N_events, N_hits = 0, 0
+        t0 = time.perf_counter()
+        try:
+            for chunk in iter_event_chunks(fname, chunk_events, reader, decoder):
+                N_events += len(chunk['event_numbers'])
+                N_hits   += chunk['hit_offsets'][-1]
+                if max_events is not None and N_events >= max_events:
+                    break
+        except ImportError as e:
+            print(f'{reader:>8}: unavailable ({e})')
+            continue
+        dt = time.perf_counter() - t0
+        print(f'{reader:>8}: {N_events} events, {N_hits} hits in {dt:.3f} s -> {N_hits/dt:,.0f} hits/s, {N_events/dt:,.1f} events/s')
+
+def resolve_codec(codec):
+    # Falls back to gzip for plugin codecs when hdf5plugin is not installed
+    name, sep, level = codec.partition(':')
+    if name not in ('none', 'gzip', 'lzf') + PLUGIN_CODECS:
+        raise ValueError(f"Unknown codec '{codec}'.")
+    if sep:
+        if name not in CODEC_LEVELS:
+            raise ValueError(f"Codec '{name}' does not take a level, got '{codec}'.")
+        lo, hi = CODEC_LEVELS[name]
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError(f"Invalid level in codec '{codec}', expected an integer from {lo} to {hi}.") from None
+        if not lo <= level <= hi:
+            raise ValueError(f"Level {level} of codec '{name}' is out of range, expected {lo} to {hi}.")
+    if name in PLUGIN_CODECS and hdf5plugin is None:
+        print(f"Warning: hdf5plugin is not installed, writing gzip instead of '{codec}'.")
+        return 'gzip'
+    return codec
+
+def codec_filters(codec, shuffle=True):
+    # create_dataset keyword arguments for a codec; shuffle groups the bytes of each element before compression
+    name, _, level = codec.partition(':')
+    level = int(level) if level else None
+    if name == 'none':
+        return {}
+    if name in PLUGIN_CODECS and hdf5plugin is None:
+        raise ImportError(f"Codec '{codec}' needs hdf5plugin.")
+    if name.startswith('blosc-'):
+        # Blosc shuffles internally
+        return dict(hdf5plugin.Blosc(cname=name[len('blosc-'):], clevel=5 if level is None else level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    if name == 'gzip':
+        filters = {'compression': 'gzip', 'compression_opts': 4 if level is None else level}
+    elif name == 'lzf':
+        filters = {'compression': 'lzf'}
+    elif name == 'lz4':
+        filters = dict(hdf5plugin.LZ4())
+    elif name == 'zstd':
+        filters = dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    else:
+        raise ValueError(f"Unknown codec '{codec}'.")
+    if shuffle:
+        filters['shuffle'] = True
+    return filters
+
+def repack_contiguous(src, dst, block=COPY_BLOCK):
+    # Copies every dataset of src into an uncompressed, contiguous dataset of dst, which can then be
+    # memory-mapped (see EventStore(memmap=True))
+    with h5py.File(src, 'r') as fin, h5py.File(dst, 'w') as fout:
+        fout.attrs.update(fin.attrs)
+
+        def copy(name, obj):
+            if isinstance(obj, h5py.Group):
+                out = fout.require_group(name)
+            else:
+                out = fout.create_dataset(name, shape=obj.shape, dtype=obj.dtype)
+                for start in range(0, obj.shape[0], block):
+                    out[start:start+block] = obj[start:start+block]
+            out.attrs.update(obj.attrs)
+        fin.visititems(copy)
+
+class HDF5EventWriter():
+    # Appends event chunks to resizable layout version 2 datasets, along with the per-event summary.
+    # codecs override DEFAULT_CODECS per group or per column; event offsets and numbers are never compressed.
+    # With contiguous=True, the events go to an uncompressed temporary file that is repacked into
+    # contiguous datasets on close(). derived=False leaves out the hit fields in DERIVED_HIT_SOURCES.
+    def __init__(self, filename, decoder=DEFAULT_DECODER, codecs=None, shuffle=True,
+                 hit_chunk=HIT_CHUNK, mc_chunk=MC_CHUNK, event_chunk=EVENT_CHUNK, contiguous=False, derived=True):
+        self.filename   = filename
+        self.decoder    = decoder
+        self.hit_attrs  = {attr: dtype for attr, dtype in HIT_ATTRS.items() if derived or attr not in DERIVED_HIT_SOURCES}
+        self.contiguous = contiguous
+        self.f          = h5py.File(f'{filename}.tmp' if contiguous else filename, 'w')
+        self.N_events   = 0
+        self.n_systems  = 1 << decoder.fields['system'][1]
+        self.codecs     = {grp: 'none' for grp in DEFAULT_CODECS} if contiguous else {**DEFAULT_CODECS, **(codecs or {})}
+        self.shuffle    = shuffle
+        self.f.attrs['layout_version']  = LAYOUT_VERSION
+        self.f.attrs['cellID_encoding'] = decoder.spec
+
+        self.N_hits, self.N_mc = 0, 0
+        for grp_name in ('HitCollection', 'MCCollection', 'EventSummary'):
+            self.f.create_group(grp_name)
+
+        # Each dataset is created with its configured chunk size once it holds a full chunk of rows, or on
+        # close() with a chunk capped at its size, so that small files do not pay for mostly empty chunks.
+        # Until then its rows are kept in _pending.
+        self._layout  = {}
+        self._pending = {}
+        self._declare('event_numbers', 'int64', event_chunk)
+        for grp_name in ('HitCollection', 'MCCollection'):
+            self._declare(f'{grp_name}/event_offsets', 'int64', event_chunk)
+            self._append(f'{grp_name}/event_offsets', np.zeros(1, dtype='int64'))
+        for attr, dtype in self.hit_attrs.items():
+            self._declare(f'HitCollection/{attr}', dtype, hit_chunk, codec=True)
+        for attr, dtype in MC_ATTRS.items():
+            self._declare(f'MCCollection/{attr}', dtype, mc_chunk, codec=True)
+        for attr, dtype in SUMMARY_ATTRS.items():
+            row = (self.n_systems,) if attr == 'E_system' else ()
+            self._declare(f'EventSummary/{attr}', dtype, event_chunk, row, codec=True)
+
+    def _declare(self, path, dtype, chunk, row=(), codec=False):
+        # codec=False for the event offsets and numbers, which are never compressed
+        if codec:
+            grp_name = path.partition('/')[0]
+            codec    = self.codecs.get(path, self.codecs.get(grp_name, 'none'))
+        self._layout[path]  = (dtype, max(1, chunk), row, codec or 'none')
+        self._pending[path] = ([], 0)
+
+    def _create(self, path):
+        dtype, chunk, row, codec = self._layout[path]
+        parts, rows = self._pending.pop(path)
+        data        = np.concatenate(parts) if parts else np.zeros((0,)+row, dtype=dtype)
+        self.f.create_dataset(path, data=data, maxshape=(None,)+row, chunks=(max(1, min(chunk, rows)),)+row,
+                              **codec_filters(codec, self.shuffle))
+
+    def _append(self, path, data):
+        if path not in self._pending:
+            dset = self.f[path]
+            n0   = dset.shape[0]
+            dset.resize((n0+len(data),) + dset.shape[1:])
+            dset[n0:] = data
+            return
+        dtype, chunk, row, _ = self._layout[path]
+        parts, rows = self._pending[path]
+        parts.append(np.asarray(data, dtype=dtype).reshape((-1,)+row))
+        self._pending[path] = (parts, rows + len(data))
+        if rows + len(data) >= chunk:
+            self._create(path)
+
+    def _append_collection(self, grp_name, offsets, columns, attrs, total):
+        self._append(f'{grp_name}/event_offsets', np.asarray(offsets[1:], dtype='int64') + total)
+        missing = [attr for attr in attrs if attr not in columns]
+        if missing:
+            # chunks read back from a file converted with --no-derived
+            columns = {**columns, **derive_hit_columns(columns, missing, self.decoder)}
+        for attr in attrs:
+            self._append(f'{grp_name}/{attr}', columns[attr])
+
+    def append(self, chunk):
+        self._append('event_numbers', chunk['event_numbers'])
+        self._append_collection('HitCollection', chunk['hit_offsets'], chunk['hits'], self.hit_attrs, self.N_hits)
+        self._append_collection('MCCollection', chunk['mc_offsets'], chunk['mc'], MC_ATTRS, self.N_mc)
+        summary = compute_event_summary(chunk['hit_offsets'], chunk['hits'], chunk['mc_offsets'], chunk['mc'], self.n_systems, self.decoder)
+        for attr in SUMMARY_ATTRS:
+            self._append(f'EventSummary/{attr}', summary[attr])
+        self.N_events += len(chunk['event_numbers'])
+        self.N_hits   += int(chunk['hit_offsets'][-1])
+        self.N_mc     += int(chunk['mc_offsets'][-1])
+
+    def write_source_info(self, inputs, source_offsets):
+        _write_source_info(self.f, inputs, source_offsets)
+
+    def close(self):
+        for path in list(self._pending):
+            self._create(path)
+        self.f.attrs['N_Events'] = self.N_events
+        self.f.close()
+        if self.contiguous:
+            repack_contiguous(f'{self.filename}.tmp', self.filename)
+            os.remove(f'{self.filename}.tmp')
+
+class ParquetEventWriter():
+    # Writes one row per event: the event number, the EventSummary fields and one list column per hit
+    # and MC field, buffered into row groups of row_group_events events
+    def __init__(self, filename, decoder=DEFAULT_DECODER, row_group_events=ROW_GROUP_EVENTS, compression='zstd', derived=True):
+        if pa is None:
+            raise ImportError('pyarrow is needed to write parquet files.')
+        self.filename         = filename
+        self.decoder          = decoder
+        self.hit_attrs        = {attr: dtype for attr, dtype in HIT_ATTRS.items() if derived or attr not in DERIVED_HIT_SOURCES}
+        self.N_events         = 0
+        self.n_systems        = 1 << decoder.fields['system'][1]
+        self.row_group_events = row_group_events
+        self.compression      = compression
+        self.metadata         = {'layout_version': str(LAYOUT_VERSION), 'cellID_encoding': decoder.spec}
+        self._writer          = None
+        self._pending         = []
+        self._pending_events  = 0
+
+    def write_source_info(self, inputs, source_offsets):
+        # must be called before the first row group is written, it goes into the schema metadata
+        self.metadata['source_files']   = json.dumps(list(inputs))
+        self.metadata['source_offsets'] = json.dumps([int(n) for n in source_offsets])
+
+    def _table(self, chunk):
+        summary = compute_event_summary(chunk['hit_offsets'], chunk['hits'], chunk['mc_offsets'], chunk['mc'], self.n_systems, self.decoder)
+        hits    = chunk['hits']
+        missing = [attr for attr in self.hit_attrs if attr not in hits]
+        if missing:
+            hits = {**hits, **derive_hit_columns(hits, missing, self.decoder)}
+        columns = {'event_number': pa.array(np.asarray(chunk['event_numbers'], dtype='int64'))}
+        for attr in SUMMARY_ATTRS:
+            if attr == 'E_system':
+                columns[f'EventSummary/{attr}'] = pa.FixedSizeListArray.from_arrays(summary[attr].ravel(), self.n_systems)
+            else:
+                columns[f'EventSummary/{attr}'] = pa.array(summary[attr])
+        for grp_name, offsets_key, values, attrs in (('HitCollection', 'hit_offsets', hits,        self.hit_attrs),
+                                                     ('MCCollection',  'mc_offsets',  chunk['mc'], MC_ATTRS)):
+            offsets = pa.array(np.asarray(chunk[offsets_key], dtype='int32'))
+            for attr, dtype in attrs.items():
+                columns[f'{grp_name}/{attr}'] = pa.ListArray.from_arrays(offsets, np.asarray(values[attr], dtype=dtype))
+        return pa.table(columns)
+
+    def _flush(self, N_events):
+        table = pa.concat_tables(self._pending)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.filename, table.schema.with_metadata(self.metadata), compression=self.compression)
+        self._writer.write_table(table.slice(0, N_events), row_group_size=max(N_events, 1))
+        rest = table.slice(N_events)
+        self._pending, self._pending_events = ([rest] if len(rest) else []), len(rest)
+
+    def append(self, chunk):
+        self._pending.append(self._table(chunk))
+        self._pending_events += len(chunk['event_numbers'])
+        self.N_events        += len(chunk['event_numbers'])
+        while self._pending_events >= self.row_group_events:
+            self._flush(self.row_group_events)
+
+    def close(self):
+        if self._writer is None and not self._pending:
+            # no events: still write the schema
+            empty = {'event_numbers': np.zeros(0, dtype='int64'),
+                     'hit_offsets': np.zeros(1, dtype='int64'), 'hits': {attr: np.zeros(0, dtype) for attr, dtype in HIT_ATTRS.items()},
+                     'mc_offsets':  np.zeros(1, dtype='int64'), 'mc':   {attr: np.zeros(0, dtype) for attr, dtype in MC_ATTRS.items()}}
+            self._pending.append(self._table(empty))
+        if self._pending:
+            self._flush(self._pending_events)
+        self._writer.close()
+
+WRITERS = {
+    'hdf5':    HDF5EventWriter,
+    'parquet': ParquetEventWriter,
+}
+FORMAT_EXTENSIONS = {
+    'hdf5':    '.hdf5',
+    'parquet': '.parquet',
+}
+
+def convert(inputROOT, outputHDF5, chunk_events=DEFAULT_CHUNK_EVENTS, reader='auto', decoder=DEFAULT_DECODER, verbose=True,
+            storage=None, fmt='hdf5'):
+    # storage: keyword arguments of the writer of format fmt (codecs, shuffle, chunk shapes, row groups)
+    writer = WRITERS[fmt](outputHDF5, decoder, **(storage or {}))
+    try:
+        for chunk in iter_event_chunks(inputROOT, chunk_events, reader, decoder):
+            writer.append(chunk)
+            if verbose:
+                print(f'Converted {writer.N_events} events')
+    finally:
+        writer.close()
+
+    if verbose:
+        print(f"All events successfully saved to {outputHDF5}")
+    return writer.N_events
+
+def _convert_shard(job):
+    inputROOT, shardHDF5, chunk_events, reader, spec, storage, fmt = job
+    return convert(inputROOT, shardHDF5, chunk_events, reader, CellIDDecoder(spec), verbose=False, storage=storage, fmt=fmt)
+
+def convert_parallel(inputs, shard_dir, chunk_events=DEFAULT_CHUNK_EVENTS, reader='auto', decoder=DEFAULT_DECODER, jobs=None,
+                     storage=None, fmt='hdf5'):
+    # Converts every input file into its own shard in a process pool, returns the shard names in input order
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = [os.path.join(shard_dir, f'{i:05d}_{os.path.splitext(os.path.basename(fname))[0]}{FORMAT_EXTENSIONS[fmt]}')
+              for i, fname in enumerate(inputs)]
+    jobs   = jobs or os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(inputs))) as pool:
+        futures = {pool.submit(_convert_shard, (fname, shard, chunk_events, reader, decoder.spec, storage, fmt)): fname
+                   for fname, shard in zip(inputs, shards)}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            fname = futures[future]
+            try:
+                N_events = future.result()
+            except Exception as e:
+                for other in futures:
+                    other.cancel()
+                raise RuntimeError(f"Conversion of '{fname}' failed: {e}") from e
+            print(f'[{n_done}/{len(inputs)}] {fname}: {N_events} events')
+
+    return shards
+
+def _shard_event_counts(shards):
+    counts = []
+    for shard in shards:
+        if h5py.is_hdf5(shard):
+            with h5py.File(shard, 'r') as f:
+                counts.append(f['event_numbers'].shape[0])
+        else:
+            counts.append(pq.ParquetFile(shard).metadata.num_rows)
+    return _event_offsets(counts)
+
+def _shard_spec(shard):
+    if h5py.is_hdf5(shard):
+        with h5py.File(shard, 'r') as f:
+            return f.attrs.get('cellID_encoding', DEFAULT_DECODER.spec)
+    return pq.read_schema(shard).metadata.get(b'cellID_encoding', DEFAULT_DECODER.spec.encode()).decode()
+
+def _write_source_info(f, inputs, source_offsets):
+    f.attrs['source_files'] = list(inputs)
+    f.create_dataset('source_offsets', data=source_offsets)
+
+def merge_shards(shards, outputHDF5, inputs, chunk_events=10*DEFAULT_CHUNK_EVENTS, storage=None, fmt='hdf5'):
+    # Concatenates shards (hdf5 or parquet) into one file of format fmt; event numbers become global indices
+    writer = WRITERS[fmt](outputHDF5, CellIDDecoder(_shard_spec(shards[0])), **(storage or {}))
+    try:
+        writer.write_source_info(inputs, _shard_event_counts(shards))
+        for shard in shards:
+            first_event = writer.N_events
+            source = iter_chunks_from_hdf5(shard, chunk_events) if h5py.is_hdf5(shard) else iter_chunks_from_parquet(shard, chunk_events)
+            for chunk in source:
+                chunk['event_numbers'] = first_event + np.arange(len(chunk['event_numbers']), dtype='int64')
+                writer.append(chunk)
+    finally:
+        writer.close()
+
+def write_shard_index(shards, indexHDF5, inputs):
+    # Writes a layout version 2 file whose columns are virtual datasets over the shards, so that
+    # it reads like a merged file without copying any hit data
+    source_offsets = _shard_event_counts(shards)
+    index_dir      = os.path.dirname(os.path.abspath(indexHDF5))
+    spec           = _shard_spec(shards[0])
+
+    with h5py.File(indexHDF5, 'w') as f:
+        f.attrs['layout_version']  = LAYOUT_VERSION
+        f.attrs['cellID_encoding'] = spec
+        f.attrs['N_Events']        = source_offsets[-1]
+        f.create_dataset('event_numbers', data=np.arange(source_offsets[-1], dtype='int64'))
+        _write_source_info(f, inputs, source_offsets)
+
+        def virtual_concat(grp, path, lengths, dtype, row=()):
+            layout = h5py.VirtualLayout(shape=(sum(lengths),)+row, dtype=dtype)
+            start  = 0
+            for shard, length in zip(shards, lengths):
+                if length > 0:
+                    source = os.path.relpath(os.path.abspath(shard), index_dir)
+                    layout[start:start+length] = h5py.VirtualSource(source, path, shape=(length,)+row)
+                start += length
+            grp.create_virtual_dataset(path.split('/')[-1], layout)
+
+        for grp_name, attrs in (('HitCollection', HIT_ATTRS), ('MCCollection', MC_ATTRS)):
+            grp = f.create_group(grp_name)
+
+            offsets, lengths = [np.zeros(1, dtype='int64')], []
+            for shard in shards:
+                with h5py.File(shard, 'r') as sf:
+                    shard_offsets = sf[grp_name]['event_offsets'][:]
+                offsets.append(shard_offsets[1:] + offsets[-1][-1])
+                lengths.append(int(shard_offsets[-1]))
+            grp.create_dataset('event_offsets', data=np.concatenate(offsets))
+
+            with h5py.File(shards[0], 'r') as sf:
+                present = set(sf[grp_name])
+            for attr, dtype in attrs.items():
+                if attr in present:
+                    virtual_concat(grp, f'{grp_name}/{attr}', lengths, dtype)
+
+        with h5py.File(shards[0], 'r') as sf:
+            summary_rows = {attr: sf['EventSummary'][attr].shape[1:] for attr in SUMMARY_ATTRS}
+        grp = f.create_group('EventSummary')
+        for attr, dtype in SUMMARY_ATTRS.items():
+            virtual_concat(grp, f'EventSummary/{attr}', np.diff(source_offsets), dtype, summary_rows[attr])
+
+def benchmark_storage(fname, codecs, chunk_events=DEFAULT_CHUNK_EVENTS, max_events=None, reader='auto',
+                      decoder=DEFAULT_DECODER, storage=None):
+    # Writes the same sample events (from a ROOT or hdf5 file) with each codec applied to every column and
+    # reports write and read throughput of the uncompressed column bytes and the compression ratio.
+    # The file is read back right after writing, so reads mostly measure decompression, not the disk.
+    if h5py.is_hdf5(fname):
+        source = iter_chunks_from_hdf5(fname, chunk_events)
+    else:
+        source = iter_event_chunks(fname, chunk_events, reader, decoder)
+    chunks, N_events = [], 0
+    for chunk in source:
+        chunks.append(chunk)
+        N_events += len(chunk['event_numbers'])
+        if max_events is not None and N_events >= max_events:
+            break
+    raw_bytes = sum(col.nbytes for chunk in chunks for key in ('hits', 'mc') for col in chunk[key].values())
+    print(f'{N_events} events, {raw_bytes/1e6:.1f} MB of hit and MC columns')
+
+    storage = {attr: value for attr, value in (storage or {}).items() if attr not in ('codecs', 'contiguous')}
+    bench_dir = tempfile.mkdtemp(prefix='codec_benchmark_')
+    try:
+        for i, codec in enumerate(codecs):
+            codec  = resolve_codec(codec)
+            output = os.path.join(bench_dir, f'{i}.hdf5')
+
+            t0 = time.perf_counter()
+            writer = HDF5EventWriter(output, decoder, codecs={grp: codec for grp in DEFAULT_CODECS}, **storage)
+            for chunk in chunks:
+                writer.append(chunk)
+            writer.close()
+            t_write = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            with h5py.File(output, 'r') as f:
+                for grp_name in ('HitCollection', 'MCCollection'):
+                    for dset in f[grp_name].values():
+                        dset[...]
+            t_read = time.perf_counter() - t0
+
+            size = os.path.getsize(output)
+            print(f'{codec:>14}: write {raw_bytes/t_write/1e6:8.1f} MB/s, read {raw_bytes/t_read/1e6:8.1f} MB/s, '
+                  f'ratio {raw_bytes/size:5.2f} ({size/1e6:.1f} MB)')
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert SCEPCal edm4hep ROOT files to hdf5 or parquet.')
+    parser.add_argument('input', nargs='+', help='input ROOT file(s) or glob pattern(s)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file (default for a single input: input with .hdf5 or .parquet extension)')
+    parser.add_argument('--format', choices=list(WRITERS), default='hdf5',
+                        help='output format: hdf5 columns, or one parquet row per event with list columns (default: hdf5)')
+    parser.add_argument('--row-group-events', type=int, default=ROW_GROUP_EVENTS,
+                        help=f'events per parquet row group (default: {ROW_GROUP_EVENTS})')
+    parser.add_argument('--parquet-compression', choices=['zstd', 'lz4', 'snappy', 'gzip', 'none'], default='zstd',
+                        help='parquet page compression (default: zstd)')
+    parser.add_argument('--chunk-events', type=int, default=DEFAULT_CHUNK_EVENTS,
+                        help=f'number of events decoded and written at a time, bounds peak memory (default: {DEFAULT_CHUNK_EVENTS})')
+    parser.add_argument('--reader', choices=['auto'] + list(READERS), default='auto',
+                        help='ROOT reader: columnar uproot or per-object PyROOT (default: uproot if installed)')
+    parser.add_argument('--compact', default=None,
+                        help='compact XML to read the readout cellID encoding from (default: system:4,eta:11,phi:11,depth:4)')
+    parser.add_argument('--readout', default='SCEPCal_readout',
+                        help='readout name in the compact XML (default: SCEPCal_readout)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes for multiple inputs (default: number of cores)')
+    parser.add_argument('--merge', choices=['copy', 'index'], default=None,
+                        help='multiple inputs: copy all events into the output file (one process re-reads and '
+                             'compresses everything), or keep per-file shards, compressed in the workers, and write '
+                             'the output as an index of virtual datasets over them (default: index for hdf5, copy for parquet)')
+    parser.add_argument('--shard-dir', default=None,
+                        help='directory for the per-file shards kept by --merge index (default: <output>_shards)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='only time the available readers on the input and report hits/s')
+    parser.add_argument('--benchmark-events', type=int, default=None,
+                        help='stop the benchmark after this many events')
+    parser.add_argument('--codec', action='append', default=[], metavar='[TARGET=]CODEC',
+                        help='compression of a group (HitCollection, MCCollection, EventSummary) or of one column '
+                             '(e.g. HitCollection/cellID=zstd:5); without a target it applies to every group. '
+                             'Codecs: none, gzip[:level], lzf, and with hdf5plugin lz4, zstd[:level], blosc-lz4[:level], '
+                             'blosc-zstd[:level] (default: HitCollection=gzip:4, others none)')
+    parser.add_argument('--contiguous', action='store_true',
+                        help='write uncompressed contiguous datasets that can be memory-mapped, '
+                             'e.g. with EventStore(filename, memmap=True) (ignores --codec and the chunk sizes)')
+    parser.add_argument('--no-derived', action='store_true',
+                        help='do not store system, neta, nphi, ndepth, r, theta and phi; HitCollection computes them '
+                             'from cellID and x, y, z when they are first accessed')
+    parser.add_argument('--no-shuffle', action='store_true',
+                        help='do not apply the byte shuffle filter before compression')
+    parser.add_argument('--hit-chunk', type=int, default=HIT_CHUNK,
+                        help=f'hdf5 chunk size in hits of the hit columns (default: {HIT_CHUNK})')
+    parser.add_argument('--mc-chunk', type=int, default=MC_CHUNK,
+                        help=f'hdf5 chunk size in particles of the MC columns (default: {MC_CHUNK})')
+    parser.add_argument('--event-chunk', type=int, default=EVENT_CHUNK,
+                        help=f'hdf5 chunk size in events of the per-event datasets (default: {EVENT_CHUNK})')
+    parser.add_argument('--benchmark-codecs', nargs='*', default=None, metavar='CODEC',
+                        help='only write the input (ROOT or hdf5) with each codec and report write MB/s, read MB/s '
+                             'and compression ratio (default codecs: none gzip:1 gzip:4 lzf, plus lz4 zstd blosc-lz4 '
+                             'with hdf5plugin)')
+    args = parser.parse_args()
+
+    if args.chunk_events < 1:
+        parser.error('--chunk-events must be at least 1')
+    if min(args.hit_chunk, args.mc_chunk, args.event_chunk) < 1:
+        parser.error('chunk sizes must be at least 1')
+    if args.format == 'parquet' and pa is None:
+        parser.error('--format parquet needs pyarrow')
+    if args.row_group_events < 1:
+        parser.error('--row-group-events must be at least 1')
+
+    codecs = {}
+    for option in args.codec:
+        target, _, codec = option.rpartition('=')
+        try:
+            codec = resolve_codec(codec)
+        except ValueError as e:
+            parser.error(str(e))
+        for key in ([target] if target else DEFAULT_CODECS):
+            if key.split('/')[0] not in DEFAULT_CODECS:
+                parser.error(f"unknown --codec target '{key}'")
+            codecs[key] = codec
+    if args.contiguous and args.codec:
+        parser.error('--contiguous datasets are uncompressed, drop --codec')
+    if args.contiguous and args.format != 'hdf5':
+        parser.error('--contiguous is only available for hdf5')
+    hdf5_storage = {'codecs': codecs, 'shuffle': not args.no_shuffle,
+                    'hit_chunk': args.hit_chunk, 'mc_chunk': args.mc_chunk, 'event_chunk': args.event_chunk,
+                    'contiguous': args.contiguous, 'derived': not args.no_derived}
+    if args.format == 'parquet':
+        storage = {'row_group_events': args.row_group_events, 'compression': args.parquet_compression,
+                   'derived': not args.no_derived}
+    else:
+        storage = hdf5_storage
+
+    inputs = expand_files(args.input)
+    if not inputs:
+        parser.error('no input files')
+    decoder = CellIDDecoder.from_compact(args.compact, args.readout) if args.compact else DEFAULT_DECODER
+
+    if len(inputs) == 1:
+        inputROOT  = inputs[0]
+        outputHDF5 = args.output if args.output else f'{os.path.splitext(inputROOT)[0]}{FORMAT_EXTENSIONS[args.format]}'
+        print(f"Input ROOT file: {inputROOT}")
+
+        if args.benchmark:
+            benchmark_readers(inputROOT, args.chunk_events, args.benchmark_events, decoder)
+            return
+        if args.benchmark_codecs is not None:
+            codec_list = args.benchmark_codecs or ['none', 'gzip:1', 'gzip:4', 'lzf'] + (['lz4', 'zstd', 'blosc-lz4'] if hdf5plugin else [])
+            for codec in codec_list:
+                try:
+                    resolve_codec(codec)
+                except ValueError as e:
+                    parser.error(str(e))
+            benchmark_storage(inputROOT, codec_list, args.chunk_events, args.benchmark_events, args.reader, decoder, hdf5_storage)
+            return
+
+        convert(inputROOT, outputHDF5, args.chunk_events, args.reader, decoder, storage=storage, fmt=args.format)
+        return
+
+    if args.benchmark or args.benchmark_codecs is not None:
+        parser.error('--benchmark and --benchmark-codecs take a single input file')
+    if not args.output:
+        parser.error('-o/--output is required with multiple input files')
+    print(f"Input ROOT files: {len(inputs)}")
+
+    outputHDF5 = args.output
+    if args.merge is None:
+        args.merge = 'index' if args.format == 'hdf5' else 'copy'
+    if args.merge == 'index' and args.format != 'hdf5':
+        parser.error('--merge index writes hdf5 virtual datasets, use --merge copy with --format parquet')
+    if args.merge == 'index':
+        shard_dir = args.shard_dir if args.shard_dir else f'{os.path.splitext(outputHDF5)[0]}_shards'
+        shards    = convert_parallel(inputs, shard_dir, args.chunk_events, args.reader, decoder, args.jobs, storage)
+        write_shard_index(shards, outputHDF5, inputs)
+    else:
+        shard_dir = tempfile.mkdtemp(prefix='shards_', dir=os.path.dirname(os.path.abspath(outputHDF5)))
+        try:
+            # shards are temporary uncompressed hdf5, only the merged file gets the requested format and compression
+            shards = convert_parallel(inputs, shard_dir, args.chunk_events, args.reader, decoder, args.jobs,
+                                      {**hdf5_storage, 'codecs': {grp: 'none' for grp in DEFAULT_CODECS}, 'contiguous': False})
+            merge_shards(shards, outputHDF5, inputs, storage=storage, fmt=args.format)
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    print(f"All events successfully saved to {outputHDF5}")
+
+if __name__ == '__main__':
+    main()
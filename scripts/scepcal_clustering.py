@@ -0,0 +1,162 @@
+import numpy as np
+
+from scepcal_utils import _ColumnCollection, HitCollection
+from scepcal_geometry import load_neighbour_index
+
+# Topological clustering of the hits of a batch of events over the crystal adjacency of the
+# segmentation (NeighbourIndex). Hits above seed_threshold start a cluster, which grows through
+# neighbouring hits above grow_threshold; hits above cell_threshold next to a cluster join the
+# cluster of their most energetic neighbour. Energies are in GeV, positions in mm.
+
+CLUSTER_ATTRS = {
+    'event':              'int64',
+    'E':                  'float64',
+    'ncerenkovprod':      'int64',
+    'nscintillationprod': 'int64',
+    'x':                  'float64',
+    'y':                  'float64',
+    'z':                  'float64',
+    'r':                  'float64',
+    'theta':              'float64',
+    'phi':                'float64',
+    'tavgc':              'float64',
+    'tavgs':              'float64',
+    'nhits':              'int32',
+    'seed':               'int64',
+    'seed_cellID':        'uint64',
+    'seed_E':             'float64',
+}
+
+class ClusterCollection(_ColumnCollection):
+    # One entry per cluster, ordered by event. event is the position of the event in the batch (or its
+    # event number for a chunk with event_numbers), seed the index of the most energetic hit in the
+    # input hits. tavgc/tavgs are the mean arrival times of all photons of the cluster.
+    _schema = CLUSTER_ATTRS
+
+def _segment_starts(keys):
+    # Start of each run of equal values in sorted keys
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype='int64')
+
+def _connected_components(n, src, dst):
+    # Smallest node index of the component of each of n nodes, for symmetric edges sorted by src:
+    # minimum label propagation with pointer jumping
+    labels = np.arange(n)
+    starts = _segment_starts(src)
+    nodes  = src[starts]
+    while True:
+        new = labels.copy()
+        if len(src):
+            new[nodes] = np.minimum(new[nodes], np.minimum.reduceat(labels[dst], starts))
+        while True:
+            jumped = new[new]
+            if np.array_equal(jumped, new):
+                break
+            new = jumped
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+class TopoClusterer():
+    def __init__(self, neighbours=None, seed_threshold=0.005, grow_threshold=0.001, cell_threshold=0.0001):
+        # neighbours: NeighbourIndex of the geometry the hits were simulated with (default: compact/SCEPCal.xml)
+        if not cell_threshold <= grow_threshold <= seed_threshold:
+            raise ValueError("Thresholds must satisfy cell_threshold <= grow_threshold <= seed_threshold.")
+        self.neighbours     = neighbours if neighbours is not None else load_neighbour_index()
+        self.cells          = self.neighbours.cells
+        self.seed_threshold = seed_threshold
+        self.grow_threshold = grow_threshold
+        self.cell_threshold = cell_threshold
+
+    def cluster_chunk(self, chunk):
+        # Clusters of a chunk of the readers in scepcal_utils (iter_chunks_from_hdf5/parquet), with event numbers
+        clusters, hit_cluster = self.cluster(chunk['hits'], chunk['hit_offsets'])
+        if 'event_numbers' in chunk:
+            clusters.event = np.asarray(chunk['event_numbers'], dtype='int64')[clusters.event]
+        return clusters, hit_cluster
+
+    def cluster(self, hits, hit_offsets=None):
+        # hits: HitCollection or dict of columns (needs cellID and E) of one event, or of several events
+        # delimited by hit_offsets. Returns the ClusterCollection and the cluster of every hit (-1: none).
+        columns = hits.columns if isinstance(hits, HitCollection) else hits
+        cellID  = np.asarray(columns['cellID'])
+        E       = np.asarray(columns['E'], dtype='float64')
+        N       = len(cellID)
+        if hit_offsets is None:
+            hit_offsets = np.array([0, N])
+        hit_offsets = np.asarray(hit_offsets, dtype='int64')
+        event = np.repeat(np.arange(len(hit_offsets) - 1), np.diff(hit_offsets))
+
+        dense   = self.cells.index(cellID)
+        unknown = int(((dense < 0) & (E > self.cell_threshold)).sum())
+        if unknown:
+            print(f"Warning: {unknown} hits have cellIDs that are not in the geometry and are not clustered.")
+
+        # hits that can join a cluster, and the edges between those that are neighbours in the same event
+        active  = np.flatnonzero((dense >= 0) & (E > self.cell_threshold))
+        nA      = len(active)
+        key     = event[active]*self.cells.N + dense[active]
+        order   = np.argsort(key, kind='stable')
+        offsets, nb = self.neighbours.query_index(dense[active])
+        src     = np.repeat(np.arange(nA), np.diff(offsets))
+        nb_key  = event[active][src]*self.cells.N + nb
+        pos     = np.minimum(np.searchsorted(key[order], nb_key), max(nA - 1, 0))
+        found   = key[order][pos] == nb_key if nA else np.zeros(0, dtype=bool)
+        src, dst = src[found], order[pos[found]]
+
+        EA      = E[active]
+        grow    = EA > self.grow_threshold
+        seed    = EA > self.seed_threshold
+        inner   = grow[src] & grow[dst]
+        labels  = _connected_components(nA, src[inner], dst[inner])
+        seeded  = np.zeros(nA, dtype=bool)
+        seeded[labels[seed]] = True
+        cluster = np.where(grow & seeded[labels], labels, -1)
+
+        # hits below grow_threshold join the cluster of their most energetic clustered neighbour
+        edge  = ~grow[src] & (cluster[dst] >= 0)
+        ps, pd = src[edge], dst[edge]
+        best  = np.lexsort((-EA[pd], ps))
+        first = best[_segment_starts(ps[best])]
+        cluster[ps[first]] = cluster[pd[first]]
+
+        # number the clusters in order of their first hit, i.e. by event
+        clustered          = cluster >= 0
+        roots, index       = np.unique(cluster[clustered], return_inverse=True)
+        hit_cluster        = np.full(N, -1, dtype='int64')
+        hit_cluster[active[clustered]] = index
+        return self._reduce(columns, E, event, dense, active[clustered], index, len(roots)), hit_cluster
+
+    def _reduce(self, columns, E, event, dense, members, index, K):
+        sum_ = lambda w: np.bincount(index, weights=w, minlength=K)
+        Eh   = E[members]
+        Ec   = sum_(Eh)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x, y, z = (sum_(Eh*getattr(self.cells, axis)[dense[members]])/Ec for axis in ('x', 'y', 'z'))
+        r = np.sqrt(x*x + y*y + z*z)
+
+        # most energetic hit of each cluster
+        best  = np.lexsort((-Eh, index))
+        seeds = members[best[_segment_starts(index[best])]]
+
+        out = {
+            'event':  event[seeds],
+            'E':      Ec,
+            'x':      x,
+            'y':      y,
+            'z':      z,
+            'r':      r,
+            'theta':  np.arccos(np.divide(z, r, out=np.zeros(K), where=r > 0)),
+            'phi':    np.arctan2(y, x),
+        }
+        for count, time in (('ncerenkovprod', 'tavgc'), ('nscintillationprod', 'tavgs')):
+            if count in columns:
+                n   = np.asarray(columns[count], dtype='float64')[members]
+                out[count] = sum_(n).astype('int64')
+                if time in columns:
+                    t = np.asarray(columns[time], dtype='float64')[members]
+                    out[time] = np.divide(sum_(n*t), out[count], out=np.zeros(K), where=out[count] > 0)
+        out['nhits']       = np.bincount(index, minlength=K).astype('int32')
+        out['seed']        = seeds
+        out['seed_cellID'] = np.asarray(columns['cellID'])[seeds]
+        out['seed_E']      = E[seeds]
+        return ClusterCollection.from_columns(out, K)
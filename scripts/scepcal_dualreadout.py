@@ -0,0 +1,121 @@
+import json
+import numpy as np
+
+from scepcal_utils import CellIDDecoder, DEFAULT_DECODER, HitCollection, derive_hit_columns
+
+# Dual-readout energy. The scintillation and Cerenkov photon counts of each hit are converted to energies
+# S and C with per-system photons/GeV, and combined as E = (S - chi*C)/(1 - chi), which corrects for the
+# fluctuating electromagnetic fraction of hadron showers. All of it is linear in the hits, so per-cluster
+# and per-event values are sums over hits and whole chunks of events are done in one array pass.
+
+def _hit_columns(hits, decoder=None):
+    # (columns, system) of a HitCollection or a dict of hit columns
+    if isinstance(hits, HitCollection):
+        return hits.columns, hits.system
+    if 'system' in hits:
+        return hits, np.asarray(hits['system'])
+    return hits, derive_hit_columns(hits, ['system'], decoder or DEFAULT_DECODER)['system']
+
+def _chunk_decoder(chunk, decoder):
+    if decoder is None and 'cellID_encoding' in chunk:
+        return CellIDDecoder(chunk['cellID_encoding'])
+    return decoder
+
+def fit_chi(S, C, E_true):
+    # Least squares chi of E_true = (S - chi*C)/(1 - chi), i.e. S - E_true = chi*(C - E_true), over
+    # per-event (or per-cluster) S and C of a hadron sample with known energy E_true
+    S, C, E_true = (np.asarray(a, dtype='float64') for a in (S, C, E_true))
+    ok = np.isfinite(S) & np.isfinite(C) & np.isfinite(E_true)
+    dS, dC = S[ok] - E_true[ok], C[ok] - E_true[ok]
+    return float((dS*dC).sum()/(dC*dC).sum())
+
+class DualReadoutCalibration():
+    # scintillation_per_GeV, cerenkov_per_GeV and chi are scalars or arrays indexed by the system field;
+    # hits of systems without a calibration (NaN or 0 photons/GeV) get S, C = 0
+    def __init__(self, scintillation_per_GeV=np.nan, cerenkov_per_GeV=np.nan, chi=0., n_systems=16):
+        self.scintillation_per_GeV = np.broadcast_to(np.asarray(scintillation_per_GeV, dtype='float64'), (n_systems,)).copy()
+        self.cerenkov_per_GeV      = np.broadcast_to(np.asarray(cerenkov_per_GeV,      dtype='float64'), (n_systems,)).copy()
+        self.chi                   = np.broadcast_to(np.asarray(chi,                   dtype='float64'), (n_systems,)).copy()
+
+    @property
+    def n_systems(self):
+        return len(self.chi)
+
+    def __repr__(self):
+        calibrated = np.flatnonzero(np.isfinite(self.scintillation_per_GeV) | np.isfinite(self.cerenkov_per_GeV))
+        return f"DualReadoutCalibration(systems={calibrated.tolist()})"
+
+    @classmethod
+    def fit(cls, chunks, decoder=None, n_systems=16):
+        # Photons/GeV of each system as the ratio of photons to deposited energy summed over a sample,
+        # e.g. an electron or photon sample for the electromagnetic scale. chunks: iterable of chunks
+        # of the readers in scepcal_utils, or of HitCollections
+        E, nS, nC = np.zeros((3, n_systems))
+        for chunk in chunks:
+            hits = chunk if isinstance(chunk, HitCollection) else chunk['hits']
+            columns, system = _hit_columns(hits, _chunk_decoder(chunk, decoder) if isinstance(chunk, dict) else None)
+            E  += np.bincount(system, weights=columns['E'],                  minlength=n_systems)
+            nS += np.bincount(system, weights=columns['nscintillationprod'], minlength=n_systems)
+            nC += np.bincount(system, weights=columns['ncerenkovprod'],      minlength=n_systems)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return cls(np.where(E > 0, nS/E, np.nan), np.where(E > 0, nC/E, np.nan), n_systems=n_systems)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'scintillation_per_GeV': self.scintillation_per_GeV.tolist(),
+                       'cerenkov_per_GeV':      self.cerenkov_per_GeV.tolist(),
+                       'chi':                   self.chi.tolist()}, f, indent=2)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            constants = json.load(f)
+        constants = {name: np.array(values, dtype='float64') for name, values in constants.items()}
+        return cls(n_systems=len(constants['chi']), **constants)
+
+    def fit_chi(self, S, C, E_true):
+        # Sets (and returns) a common chi for all systems, see fit_chi
+        chi = fit_chi(S, C, E_true)
+        self.chi[:] = chi
+        return chi
+
+    @staticmethod
+    def _GeV_per_photon(per_GeV):
+        calibrated = np.isfinite(per_GeV) & (per_GeV > 0)
+        return np.divide(1., per_GeV, out=np.zeros(len(per_GeV)), where=calibrated)
+
+    def correct_hits(self, hits, decoder=None):
+        # (S, C, E) of every hit, in GeV
+        columns, system = _hit_columns(hits, decoder)
+        S   = np.asarray(columns['nscintillationprod'], dtype='float64')*self._GeV_per_photon(self.scintillation_per_GeV)[system]
+        C   = np.asarray(columns['ncerenkovprod'],      dtype='float64')*self._GeV_per_photon(self.cerenkov_per_GeV)[system]
+        chi = self.chi[system]
+        return S, C, (S - chi*C)/(1 - chi)
+
+    def correct_events(self, hits, hit_offsets=None, decoder=None):
+        # (S, C, E) of every event of hits delimited by hit_offsets (default: a single event)
+        S, C, E = self.correct_hits(hits, decoder)
+        if hit_offsets is None:
+            hit_offsets = np.array([0, len(S)])
+        event = np.repeat(np.arange(len(hit_offsets) - 1), np.diff(hit_offsets))
+        return tuple(np.bincount(event, weights=w, minlength=len(hit_offsets) - 1) for w in (S, C, E))
+
+    def correct_clusters(self, hits, hit_cluster, n_clusters=None, decoder=None):
+        # (S, C, E) of every cluster, for the hit membership returned by TopoClusterer.cluster
+        S, C, E = self.correct_hits(hits, decoder)
+        hit_cluster = np.asarray(hit_cluster)
+        member      = hit_cluster >= 0
+        n_clusters  = n_clusters if n_clusters is not None else int(hit_cluster.max(initial=-1)) + 1
+        return tuple(np.bincount(hit_cluster[member], weights=w[member], minlength=n_clusters) for w in (S, C, E))
+
+    def correct_chunks(self, chunks, decoder=None):
+        # Per-event S, C, E and event numbers over an iterable of chunks, e.g. a whole production through
+        # iter_chunks_from_hdf5(..., columns=['cellID', 'nscintillationprod', 'ncerenkovprod'], mc_columns=[])
+        out = {'event_numbers': [], 'S': [], 'C': [], 'E': []}
+        for chunk in chunks:
+            S, C, E = self.correct_events(chunk['hits'], chunk['hit_offsets'], _chunk_decoder(chunk, decoder))
+            out['event_numbers'].append(np.asarray(chunk['event_numbers']))
+            out['S'].append(S)
+            out['C'].append(C)
+            out['E'].append(E)
+        return {name: np.concatenate(values) if values else np.zeros(0) for name, values in out.items()}
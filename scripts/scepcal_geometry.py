@@ -0,0 +1,470 @@
+import os
+import hashlib
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from scepcal_utils import CellIDDecoder, DEFAULT_DECODER
+
+# Python port of SCEPCalSegmentation::myPosition (src/SCEPCalSegmentation.cpp) and of the crystal
+# placement loops of SCEPCalConstructor.cpp. Lengths are in mm, like the hit positions in the files.
+
+BARREL          = 4
+ENDCAP          = 5
+TIMING          = 6
+PROJECTIVE_FILL = 7
+
+# units of the compact file expressions, in mm and rad
+UNITS = {
+    'm':    1000.,
+    'cm':   10.,
+    'mm':   1.,
+    'um':   1e-3,
+    'rad':  1.,
+    'mrad': 1e-3,
+    'deg':  np.pi/180,
+    'pi':   np.pi,
+}
+
+DEFAULT_COMPACT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'compact', 'SCEPCal.xml')
+CELL_TABLE_VERSION = 1
+
+def _evaluate(expression, constants):
+    return float(eval(expression, {'__builtins__': {}}, {**UNITS, **constants}))
+
+def _rotate_z(angle, a, b):
+    return a*np.cos(angle) - b*np.sin(angle), a*np.sin(angle) + b*np.cos(angle)
+
+class SCEPCalGeometry():
+    # Geometry parameters of the <dim> element of a compact file and the derived quantities,
+    # named as in the C++ code. position() is myPosition vectorized over arrays of cellIDs.
+    def __init__(self, Fdz=50., Rdz=150., nomfw=10., nomth=3., EBz=2400., Rin=2250., sipmth=0.5,
+                 phi_segments=128, n_projective_fill=3, construct=None, decoder=DEFAULT_DECODER):
+        self.Fdz               = Fdz
+        self.Rdz               = Rdz
+        self.nomfw             = nomfw
+        self.nomth             = nomth
+        self.EBz               = EBz
+        self.Rin               = Rin
+        self.sipmth            = sipmth
+        self.PHI_SEGMENTS      = int(phi_segments)
+        self.N_PROJECTIVE_FILL = int(n_projective_fill)
+        self.decoder           = decoder
+        # which parts were built: flags and phi/theta ranges of the <timing>, <barrel>, <endcap> elements
+        self.construct = {
+            'timing': False, 'barrel': True, 'endcap': True,
+            'barrel_phi': (0, self.PHI_SEGMENTS), 'endcap_phi': (0, self.PHI_SEGMENTS), 'endcap_theta_start': 0,
+        }
+        self.construct.update(construct or {})
+
+        self.D_PHI_GLOBAL         = 2*np.pi/self.PHI_SEGMENTS
+        self.PROJECTIVE_GAP       = (self.N_PROJECTIVE_FILL*nomfw)/2
+        self.THETA_SIZE_ENDCAP    = np.arctan(Rin/EBz)
+        self.N_THETA_BARREL       = int(2*np.floor(EBz/nomfw))
+        self.N_THETA_ENDCAP       = int(np.floor(Rin/nomfw))
+        self.D_THETA_BARREL       = (np.pi-2*self.THETA_SIZE_ENDCAP)/self.N_THETA_BARREL
+        self.D_THETA_ENDCAP       = self.THETA_SIZE_ENDCAP/self.N_THETA_ENDCAP
+        self.N_PHI_BARREL_CRYSTAL = int(np.floor(2*np.pi*Rin/(self.PHI_SEGMENTS*nomfw)))
+        self.D_PHI_BARREL_CRYSTAL = self.D_PHI_GLOBAL/self.N_PHI_BARREL_CRYSTAL
+
+        # timing layer
+        thC_end         = self.THETA_SIZE_ENDCAP + self.D_THETA_BARREL/2
+        r0slice_end     = Rin/np.sin(thC_end)
+        y0slice_end     = r0slice_end*np.tan(self.D_THETA_BARREL/2)
+        slice_front_jut = y0slice_end*np.sin(np.pi/2-thC_end)
+        z1slice         = Rin - slice_front_jut
+        self.y1slice    = z1slice*np.tan(np.pi/2-self.THETA_SIZE_ENDCAP) + self.PROJECTIVE_GAP
+        self.rT         = z1slice - 2*nomth
+        self.wT         = self.rT*np.tan(self.D_PHI_GLOBAL/2)
+        self.nTiles     = int(np.ceil(self.y1slice/self.wT))
+        self.lT         = 2*self.y1slice/self.nTiles
+        self.nCy        = int(np.floor(self.lT/nomth))
+        self.actY       = self.lT/self.nCy
+        self.actX       = 2*self.wT/self.nCy
+
+    @classmethod
+    def from_compact(cls, compactfile=DEFAULT_COMPACT, detector='SCEPCal'):
+        root      = ET.parse(compactfile).getroot()
+        constants = {}
+        for define in root.iter('define'):
+            for constant in define.iter('constant'):
+                constants[constant.get('name')] = _evaluate(constant.get('value'), constants)
+
+        det = next((d for d in root.iter('detector') if d.get('name') == detector), None)
+        if det is None:
+            raise ValueError(f"No detector '{detector}' in '{compactfile}'.")
+        dim = det.find('dim').attrib
+        length = lambda name: _evaluate(dim[name], constants)
+
+        construct = {}
+        for part in ('timing', 'barrel', 'endcap'):
+            element = det.find(part)
+            if element is not None:
+                construct[part] = element.get('construct', 'true').lower() in ('true', '1')
+                if part != 'timing':
+                    construct[f'{part}_phi'] = (int(element.get('phistart')), int(element.get('phiend')))
+                if part == 'endcap':
+                    construct['endcap_theta_start'] = int(element.get('thetastart'))
+
+        decoder = DEFAULT_DECODER
+        if det.get('readout') is not None:
+            decoder = CellIDDecoder.from_compact(compactfile, det.get('readout'))
+
+        return cls(Fdz=length('crystalFlength'), Rdz=length('crystalRlength'), nomfw=length('crystalFaceWidthNominal'),
+                   nomth=length('crystalTimingThicknessNominal'), EBz=length('barrelHalfZ'), Rin=length('barrelInnerR'),
+                   sipmth=length('sipmThickness'), phi_segments=int(length('phiSegments')),
+                   n_projective_fill=int(length('projectiveFill')), construct=construct, decoder=decoder)
+
+    @property
+    def params(self):
+        return {'Fdz': self.Fdz, 'Rdz': self.Rdz, 'nomfw': self.nomfw, 'nomth': self.nomth, 'EBz': self.EBz,
+                'Rin': self.Rin, 'sipmth': self.sipmth, 'phi_segments': self.PHI_SEGMENTS,
+                'n_projective_fill': self.N_PROJECTIVE_FILL, 'construct': self.construct, 'readout': self.decoder.spec}
+
+    def cache_key(self):
+        return hashlib.sha1(repr((CELL_TABLE_VERSION, sorted(self.params.items()))).encode()).hexdigest()[:16]
+
+    def n_phi_endcap_crystal(self, nTheta):
+        thC = self.D_THETA_ENDCAP/2 + nTheta*self.D_THETA_ENDCAP
+        return np.floor(2*np.pi*self.EBz*np.tan(thC)/(self.PHI_SEGMENTS*self.nomfw)).astype('int64')
+
+    def rings(self):
+        # (system, eta, crystals around the full ring, mirrored) of every crystal ring, in order of theta from
+        # the +z endcap through the barrel and projective fill to the -z endcap: consecutive rings are adjacent
+        endcap = [(iTheta, int(self.n_phi_endcap_crystal(iTheta))*self.PHI_SEGMENTS) for iTheta in range(self.N_THETA_ENDCAP)]
+        endcap = [(iTheta, n) for iTheta, n in endcap if n > 0]
+        barrel = self.N_PHI_BARREL_CRYSTAL*self.PHI_SEGMENTS
+        half   = self.N_THETA_ENDCAP + self.N_THETA_BARREL//2
+        return [(ENDCAP, iTheta, n, False) for iTheta, n in endcap] \
+             + [(BARREL, eta, barrel, False) for eta in range(self.N_THETA_ENDCAP, half)] \
+             + [(PROJECTIVE_FILL, eta, barrel, False) for eta in reversed(range(self.N_PROJECTIVE_FILL))] \
+             + [(BARREL, eta, barrel, False) for eta in range(half, self.N_THETA_ENDCAP + self.N_THETA_BARREL)] \
+             + [(ENDCAP, 2*self.N_THETA_ENDCAP + self.N_THETA_BARREL - iTheta, n, True) for iTheta, n in reversed(endcap)]
+
+    def unmirror_phi(self, phi, n):
+        # The -z endcap is rotated by pi around y, so its crystal phi of a ring of n crystals covers the
+        # azimuth of crystal unmirror_phi(phi, n) of an unrotated ring (exact for an even phiSegments)
+        return (n//2 + n//self.PHI_SEGMENTS - 1 - phi) % n
+
+    def cellID(self, system, eta, phi, depth):
+        # Readout fields other than system, eta, phi, depth are 0
+        values = dict.fromkeys(self.decoder.fields, 0)
+        values.update(system=system, eta=eta, phi=phi, depth=depth)
+        return self.decoder.encode(**values)
+
+    def position(self, cellID):
+        # (x, y, z) of the cell centres; (0, 0, 0) for cellIDs outside the segmentation, as in C++
+        cellID = np.asarray(cellID, dtype='uint64')
+        return self.position_from_fields(*(self.decoder.get(cellID, name) for name in ('system', 'eta', 'phi', 'depth')))
+
+    def position_from_fields(self, system, eta, phi, depth):
+        return self._evaluate(system, eta, phi, depth)[:3]
+
+    def crystal_size(self, system, eta, phi, depth):
+        # Extent of the cells at their centre along the crystal axis, the theta and the phi directions
+        return self._evaluate(system, eta, phi, depth)[3:]
+
+    def _evaluate(self, system, eta, phi, depth):
+        system, eta, phi, depth = np.broadcast_arrays(*(np.asarray(a, dtype='int64') for a in (system, eta, phi, depth)))
+        out = np.zeros((6,) + system.shape)
+        for value, part in ((BARREL, self._barrel), (ENDCAP, self._endcap), (TIMING, self._timing), (PROJECTIVE_FILL, self._projective_fill)):
+            sel = system == value
+            if sel.any():
+                out[:, sel] = part(eta[sel], phi[sel], depth[sel])
+        return tuple(out)
+
+    def _crystal(self, thC, dtheta, rSlice, phi_slice, gamma, dgamma, r0e, depth, z_offset, size_theta=None):
+        # Front (depth 1) and rear (depth 2) crystals of a projective slice
+        rc    = np.where(depth == 1, r0e + self.Fdz/2, r0e + self.Fdz + self.Rdz/2)
+        a     = rc*np.sin(thC) - rSlice
+        b     = rc*np.sin(thC)*np.tan(gamma)
+        x, y  = _rotate_z(phi_slice, rSlice + a, b)
+        z     = rc*np.cos(thC) + z_offset
+        size  = [np.where(depth == 1, self.Fdz, self.Rdz),
+                 2*rc*np.tan(dtheta/2) if size_theta is None else np.full(len(rc), size_theta),
+                 rc*np.sin(thC)*(np.tan(gamma+dgamma/2) - np.tan(gamma-dgamma/2))]
+        valid = (depth == 1) | (depth == 2)
+        return np.where(valid, np.array([x, y, z] + size), 0.)
+
+    def _barrel(self, eta, phi, depth):
+        nTheta          = eta - self.N_THETA_ENDCAP
+        nPhi, nGamma    = phi // self.N_PHI_BARREL_CRYSTAL, phi % self.N_PHI_BARREL_CRYSTAL
+        gamma           = -self.D_PHI_GLOBAL/2 + self.D_PHI_BARREL_CRYSTAL/2 + self.D_PHI_BARREL_CRYSTAL*nGamma
+        thC             = self.THETA_SIZE_ENDCAP + self.D_THETA_BARREL/2 + nTheta*self.D_THETA_BARREL
+        projective_sign = np.where(np.cos(thC) > 0, -1, 1)
+        return self._crystal(thC, self.D_THETA_BARREL, self.Rin + (self.Fdz+self.Rdz)/2, nPhi*self.D_PHI_GLOBAL,
+                             gamma, self.D_PHI_BARREL_CRYSTAL, self.Rin/np.sin(thC), depth, -projective_sign*self.PROJECTIVE_GAP)
+
+    def _projective_fill(self, eta, phi, depth):
+        nPhi, nGamma = phi // self.N_PHI_BARREL_CRYSTAL, phi % self.N_PHI_BARREL_CRYSTAL
+        gamma        = -self.D_PHI_GLOBAL/2 + self.D_PHI_BARREL_CRYSTAL/2 + self.D_PHI_BARREL_CRYSTAL*nGamma
+        thC          = np.full(len(eta), np.pi/2)
+        z_offset     = -self.nomfw*(self.N_PROJECTIVE_FILL-1)/2 + eta*self.nomfw
+        return self._crystal(thC, 0., self.Rin + (self.Fdz+self.Rdz)/2, nPhi*self.D_PHI_GLOBAL,
+                             gamma, self.D_PHI_BARREL_CRYSTAL, self.Rin/np.sin(thC), depth, z_offset, size_theta=self.nomfw)
+
+    def _endcap(self, eta, phi, depth):
+        mirror            = eta >= self.N_THETA_ENDCAP
+        nTheta            = np.where(mirror, 2*self.N_THETA_ENDCAP + self.N_THETA_BARREL - eta, eta)
+        thC               = self.D_THETA_ENDCAP/2 + nTheta*self.D_THETA_ENDCAP
+        RinEndcap         = self.EBz*np.tan(thC)
+        nPhiEndcapCrystal = np.maximum(self.n_phi_endcap_crystal(nTheta), 1)
+        dPhiEndcapCrystal = self.D_PHI_GLOBAL/nPhiEndcapCrystal
+        nPhi, nGamma      = phi // nPhiEndcapCrystal, phi % nPhiEndcapCrystal
+        gamma             = -self.D_PHI_GLOBAL/2 + dPhiEndcapCrystal/2 + dPhiEndcapCrystal*nGamma
+        out = self._crystal(thC, self.D_THETA_ENDCAP, RinEndcap + (self.Fdz+self.Rdz)/2, nPhi*self.D_PHI_GLOBAL,
+                            gamma, dPhiEndcapCrystal, RinEndcap/np.sin(thC), depth, self.PROJECTIVE_GAP)
+        # rotation by pi around y for the mirrored endcap
+        out[0] = np.where(mirror, -out[0], out[0])
+        out[2] = np.where(mirror, -out[2], out[2])
+        # eta in the barrel range, or a ring too small to hold a crystal, is not an endcap cell
+        valid  = ((eta < self.N_THETA_ENDCAP) | (eta > self.N_THETA_ENDCAP + self.N_THETA_BARREL)) \
+               & (self.n_phi_endcap_crystal(nTheta) >= 1)
+        return np.where(valid, out, 0.)
+
+    def _timing(self, eta, phi, depth):
+        nTile    = eta // self.nCy
+        nC       = eta - nTile*self.nCy
+        sign     = np.where(nTile % 2 == 0, 1, -1) * np.where(phi % 2 == 0, 1, -1)
+        zero     = np.zeros(len(eta))
+        # tile assembly frame: a radial, b along phi, c along z
+        a0, c0   = self.rT + self.nomth, -self.y1slice + nTile*self.lT + self.lT/2
+        lg       = (sign*self.nomth/2,  -self.wT + self.actX/2 + nC*self.actX, zero)
+        tr       = (-sign*self.nomth/2, zero,                                  -self.lT/2 + self.actY/2 + nC*self.actY)
+        sipm_lg  = (0., 0., self.lT/2 - self.sipmth/2)
+        sipm_tr  = (0., self.wT - self.sipmth/2, 0.)
+
+        a, b, c = np.zeros((3, len(eta)))
+        size    = np.zeros((3, len(eta)))
+        for d, base, shift, sipm_sign, dims in ((3, lg, sipm_lg,  0, (self.nomth, self.lT - 2*self.sipmth, self.actX)),
+                                                (4, lg, sipm_lg,  1, (self.nomth, self.sipmth, self.actX)),
+                                                (5, lg, sipm_lg, -1, (self.nomth, self.sipmth, self.actX)),
+                                                (6, tr, sipm_tr,  0, (self.nomth, self.actY, 2*self.wT - 2*self.sipmth)),
+                                                (7, tr, sipm_tr,  1, (self.nomth, self.actY, self.sipmth)),
+                                                (8, tr, sipm_tr, -1, (self.nomth, self.actY, self.sipmth))):
+            sel = depth == d
+            a[sel] = a0 + (base[0] + sipm_sign*shift[0])[sel]
+            b[sel] = (base[1] + sipm_sign*shift[1])[sel]
+            c[sel] = (c0 + base[2] + sipm_sign*shift[2])[sel]
+            size[:, sel] = np.array(dims)[:, None]
+        x, y = _rotate_z(phi*self.D_PHI_GLOBAL, a, b)
+        return np.array([x, y, c, *size])
+
+    def cells(self):
+        # system, eta, phi, depth of every cell that is built, following the loops of SCEPCalConstructor.cpp
+        parts = []
+        if self.construct['barrel']:
+            iPhi = np.arange(*self.construct['barrel_phi'])
+            phi  = (iPhi[:, None]*self.N_PHI_BARREL_CRYSTAL + np.arange(self.N_PHI_BARREL_CRYSTAL)).ravel()
+            parts.append((BARREL, self.N_THETA_ENDCAP + np.arange(self.N_THETA_BARREL), phi, (1, 2)))
+            parts.append((PROJECTIVE_FILL, np.arange(self.N_PROJECTIVE_FILL), phi, (1, 2)))
+            if self.construct['timing']:
+                parts.append((TIMING, np.arange(self.nTiles*self.nCy), iPhi, (3, 4, 5, 6, 7, 8)))
+        if self.construct['endcap']:
+            for iTheta in range(self.construct['endcap_theta_start'], self.N_THETA_ENDCAP):
+                nPhiEndcapCrystal = int(self.n_phi_endcap_crystal(iTheta))
+                iPhi = np.arange(*self.construct['endcap_phi'])
+                phi  = (iPhi[:, None]*nPhiEndcapCrystal + np.arange(nPhiEndcapCrystal)).ravel()
+                mirrored = 2*self.N_THETA_ENDCAP + self.N_THETA_BARREL - iTheta
+                parts.append((ENDCAP, np.array([iTheta, mirrored]), phi, (1, 2)))
+
+        columns = {'system': [], 'eta': [], 'phi': [], 'depth': []}
+        for system, eta, phi, depths in parts:
+            eta, phi, depth = (a.ravel() for a in np.meshgrid(eta, phi, depths, indexing='ij'))
+            columns['system'].append(np.full(len(eta), system))
+            columns['eta'].append(eta)
+            columns['phi'].append(phi)
+            columns['depth'].append(depth)
+        return {name: np.concatenate(arrays).astype('int32') if arrays else np.zeros(0, dtype='int32')
+                for name, arrays in columns.items()}
+
+    def build_cell_table(self):
+        fields = self.cells()
+        x, y, z, size_r, size_theta, size_phi = self._evaluate(fields['system'], fields['eta'], fields['phi'], fields['depth'])
+        r      = np.sqrt(x*x + y*y + z*z)
+        cellID = self.cellID(fields['system'], fields['eta'], fields['phi'], fields['depth'])
+        order  = np.argsort(cellID)
+        columns = {
+            'cellID':     cellID,
+            'system':     fields['system'],
+            'neta':       fields['eta'],
+            'nphi':       fields['phi'],
+            'ndepth':     fields['depth'],
+            'x':          x,
+            'y':          y,
+            'z':          z,
+            'r':          r,
+            'theta':      np.arccos(z/r),
+            'phi':        np.arctan2(y, x),
+            'size_r':     size_r,
+            'size_theta': size_theta,
+            'size_phi':   size_phi,
+        }
+        return CellTable({name: column[order] for name, column in columns.items()}, self.params)
+
+class CellTable():
+    # Every built cell, sorted by cellID. The row of a cell is its dense index:
+    # table.x[table.index(cellIDs)] is the position of each cellID in a single lookup.
+    def __init__(self, columns, params=None):
+        self._attrs = tuple(columns)
+        self.params = params or {}
+        self.N      = len(columns['cellID'])
+        self.__dict__.update(columns)
+
+    def __len__(self):
+        return self.N
+
+    @property
+    def columns(self):
+        return {attr: getattr(self, attr) for attr in self._attrs}
+
+    def index(self, cellID):
+        # Dense index of each cellID, -1 for cellIDs that are not in the table
+        cellID = np.asarray(cellID, dtype='uint64')
+        index  = np.minimum(np.searchsorted(self.cellID, cellID), max(self.N-1, 0))
+        found  = self.cellID[index] == cellID if self.N else np.zeros(cellID.shape, dtype=bool)
+        return np.where(found, index, -1)
+
+    def lookup(self, cellID, attr):
+        # Column attr for each cellID, NaN (or -1 for integer columns) where unknown
+        index  = self.index(cellID)
+        column = getattr(self, attr)
+        fill   = np.nan if column.dtype.kind == 'f' else -1
+        return np.where(index >= 0, column[np.maximum(index, 0)], fill)
+
+    def position(self, cellID):
+        return tuple(self.lookup(cellID, attr) for attr in ('x', 'y', 'z'))
+
+    def save(self, filename):
+        np.savez(filename, **self.columns)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            return cls({name: f[name] for name in f.files})
+
+class NeighbourIndex():
+    # Neighbours of every cell in CSR form over the dense cell index of a CellTable: the neighbours of
+    # cell i are neighbours[offsets[i]:offsets[i+1]]. Crystals of a depth layer neighbour the crystals
+    # sharing an edge or a corner in (theta, phi), also across the barrel/endcap boundary, the projective
+    # fill and endcap rings of different nPhiEndcapCrystal; the front and rear crystal of a tower are
+    # neighbours. Timing bars neighbour the adjacent bars of the same orientation and their SiPMs.
+    def __init__(self, cells, offsets, neighbours):
+        self.cells      = cells
+        self.offsets    = offsets
+        self.neighbours = neighbours
+
+    def __len__(self):
+        return self.cells.N
+
+    @classmethod
+    def from_geometry(cls, geometry, cells=None):
+        cells = cells if cells is not None else geometry.build_cell_table()
+        src, dst = [], []
+
+        def link(a, b):
+            # a, b: (system, eta, phi, depth) of pairs of cells, kept where both cells are built
+            ia, ib = cells.index(geometry.cellID(*a)), cells.index(geometry.cellID(*b))
+            keep   = (ia >= 0) & (ib >= 0)
+            src.append(ia[keep])
+            dst.append(ib[keep])
+
+        rings = geometry.rings()
+        for depth in (1, 2):
+            for system, eta, n, mirrored in rings:
+                p = np.arange(n)
+                link((system, eta, p, depth), (system, eta, (p+1) % n, depth))
+                if depth == 1:
+                    link((system, eta, p, 1), (system, eta, p, 2))
+            for (systemA, etaA, nA, mirroredA), (systemB, etaB, nB, mirroredB) in zip(rings[:-1], rings[1:]):
+                # crystal pA spans [pA, pA+1)/nA of the ring, link every pB whose span touches it
+                pA    = np.arange(nA)
+                qA    = geometry.unmirror_phi(pA, nA) if mirroredA else pA
+                lo    = (qA*nB + nA - 1)//nA - 1
+                hi    = ((qA+1)*nB)//nA
+                k     = np.arange((hi - lo).max() + 1)
+                keep  = k[None, :] <= (hi - lo)[:, None]
+                pB    = ((lo[:, None] + k[None, :]) % nB)[keep]
+                pB    = geometry.unmirror_phi(pB, nB) if mirroredB else pB
+                pA    = np.broadcast_to(pA[:, None], keep.shape)[keep]
+                link((systemA, etaA, pA, depth), (systemB, etaB, pB, depth))
+
+        timing = cells.system == TIMING
+        eta, phi, depth = cells.neta[timing], cells.nphi[timing], cells.ndepth[timing]
+        # bars along z (3) lie side by side within their tile, bars along phi (6) are stacked in z across tiles
+        bars = (depth == 6) | ((depth == 3) & ((eta + 1)//geometry.nCy == eta//geometry.nCy))
+        link((TIMING, eta[bars], phi[bars], depth[bars]), (TIMING, eta[bars] + 1, phi[bars], depth[bars]))
+        for bar, sipm in ((3, 4), (3, 5), (6, 7), (6, 8)):
+            sel = depth == bar
+            link((TIMING, eta[sel], phi[sel], bar), (TIMING, eta[sel], phi[sel], sipm))
+
+        # both directions, without duplicates or links of a cell to itself
+        src, dst = np.concatenate(src).astype('int64'), np.concatenate(dst).astype('int64')
+        keys     = np.sort(np.concatenate([src*cells.N + dst, dst*cells.N + src]))
+        src, dst = keys // cells.N, keys % cells.N
+        keep     = (src != dst) & np.r_[True, keys[1:] != keys[:-1]]
+        offsets  = np.zeros(cells.N + 1, dtype='int64')
+        np.cumsum(np.bincount(src[keep], minlength=cells.N), out=offsets[1:])
+        return cls(cells, offsets, dst[keep].astype('int32'))
+
+    def query_index(self, index):
+        # (offsets, dense indices) of the neighbours of each dense index, in CSR form; -1 has none
+        index   = np.asarray(index, dtype='int64')
+        valid   = index >= 0
+        starts  = np.where(valid, self.offsets[np.maximum(index, 0)], 0)
+        counts  = np.where(valid, self.offsets[np.maximum(index, 0) + 1], 0) - starts
+        offsets = np.zeros(len(index) + 1, dtype='int64')
+        np.cumsum(counts, out=offsets[1:])
+        flat    = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)
+        return offsets, self.neighbours[flat]
+
+    def query(self, cellID):
+        # (offsets, cellIDs) of the neighbours of each cellID, in CSR form; unknown cellIDs have none
+        offsets, index = self.query_index(self.cells.index(cellID))
+        return offsets, self.cells.cellID[index]
+
+    def count(self, cellID):
+        index = self.cells.index(cellID)
+        return np.where(index >= 0, self.offsets[index + 1] - self.offsets[np.maximum(index, 0)], 0)
+
+    def save(self, filename):
+        np.savez(filename, offsets=self.offsets, neighbours=self.neighbours)
+
+    @classmethod
+    def load(cls, filename, cells):
+        with np.load(filename) as f:
+            return cls(cells, f['offsets'], f['neighbours'])
+
+def default_cache_dir():
+    return os.environ.get('SCEPCAL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'scepcal'))
+
+def _cached(geometry, name, cache_dir, rebuild, build, load):
+    # build() once and then load() from cache_dir; the cache file name is a hash of the geometry
+    # parameters, so a changed geometry gets its own file
+    cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+    cachefile = os.path.join(cache_dir, f'scepcal_{name}_{geometry.cache_key()}.npz')
+
+    if not rebuild and os.path.exists(cachefile):
+        return load(cachefile)
+
+    result = build()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpfile = f'{cachefile}.{os.getpid()}.npz'
+        result.save(tmpfile)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        print(f"Warning: Could not cache the {name} in '{cache_dir}': {e}")
+    return result
+
+def load_cell_table(compactfile=DEFAULT_COMPACT, detector='SCEPCal', cache_dir=None, rebuild=False):
+    geometry = SCEPCalGeometry.from_compact(compactfile, detector)
+    table    = _cached(geometry, 'cells', cache_dir, rebuild, geometry.build_cell_table, CellTable.load)
+    table.params = geometry.params
+    return table
+
+def load_neighbour_index(compactfile=DEFAULT_COMPACT, detector='SCEPCal', cache_dir=None, rebuild=False):
+    geometry = SCEPCalGeometry.from_compact(compactfile, detector)
+    cells    = load_cell_table(compactfile, detector, cache_dir, rebuild)
+    return _cached(geometry, 'neighbours', cache_dir, rebuild,
+                   lambda: NeighbourIndex.from_geometry(geometry, cells),
+                   lambda cachefile: NeighbourIndex.load(cachefile, cells))
@@ -0,0 +1,142 @@
+import numpy as np
+
+from scepcal_utils import HitCollection
+from scepcal_geometry import BARREL, load_cell_table
+
+# Hits of a batch of events as fixed-shape (eta, phi, depth) images of one system, for ML training.
+# The eta axis runs over the theta rings of the system, the phi axis over the crystals of a ring and the
+# depth axis over its depth layers. With a window, the image is centred on a direction (by default the
+# primary MC particle): eta is counted in rings from the ring closest in theta, and phi in crystals of
+# each ring from the direction's azimuth.
+
+def _wrap(angle):
+    return (angle + np.pi) % (2*np.pi) - np.pi
+
+def primary_directions(mc_offsets, mc):
+    # (theta, phi) of the first MC particle with generatorStatus==1 of each event, NaN if there is none
+    N_events  = len(mc_offsets) - 1
+    mc_event  = np.repeat(np.arange(N_events), np.diff(mc_offsets))
+    primaries = np.flatnonzero(np.asarray(mc['generatorStatus']) == 1)
+    events, first = np.unique(mc_event[primaries], return_index=True)
+    first = primaries[first]
+    px, py, pz = (np.asarray(mc[attr], dtype='float64')[first] for attr in ('px', 'py', 'pz'))
+    theta, phi = np.full((2, N_events), np.nan)
+    theta[events] = np.arctan2(np.sqrt(px*px + py*py), pz)
+    phi[events]   = np.arctan2(py, px)
+    return theta, phi
+
+class TensorExporter():
+    # channels: hit columns summed into each voxel, e.g. ('E', 'nscintillationprod', 'ncerenkovprod').
+    # window: (half width in rings, half width in crystals) around a direction, None for the whole system.
+    def __init__(self, cells=None, system=BARREL, channels=('E',), window=None):
+        self.cells    = cells if cells is not None else load_cell_table()
+        self.system   = system
+        self.channels = tuple(channels)
+        self.window   = window
+
+        sel        = self.cells.system == system
+        rings      = np.unique(self.cells.neta[sel])
+        depths     = np.unique(self.cells.ndepth[sel])
+        if not len(rings):
+            raise ValueError(f"No cells of system {system} in the cell table.")
+        ring_rank  = np.searchsorted(rings, self.cells.neta)
+        depth_rank = np.searchsorted(depths, self.cells.ndepth)
+
+        # per cell: ring and depth layer (-1 for other systems), per ring: theta and crystal count
+        self._cell_ring  = np.where(sel, ring_rank, -1)
+        self._cell_depth = np.where(sel, depth_rank, -1)
+        front            = sel & (self.cells.ndepth == depths[0])
+        self.ring_theta  = np.bincount(ring_rank[front], weights=self.cells.theta[front], minlength=len(rings)) \
+                         / np.maximum(np.bincount(ring_rank[front], minlength=len(rings)), 1)
+        self.ring_nphi   = np.zeros(len(rings), dtype='int64')
+        np.maximum.at(self.ring_nphi, ring_rank[sel], self.cells.nphi[sel].astype('int64') + 1)
+        self.rings, self.depths = rings, depths
+
+        # azimuth of crystal 0 of each ring and the direction in which the crystal index runs (-1 in the -z endcap)
+        cells = np.flatnonzero(front)
+        cells = cells[np.lexsort((self.cells.nphi[cells], ring_rank[cells]))]
+        ring  = ring_rank[cells]
+        first = np.flatnonzero(np.r_[True, ring[1:] != ring[:-1]])
+        nxt   = np.minimum(first + 1, len(cells) - 1)
+        pitch = 2*np.pi/self.ring_nphi[ring[first]]
+        self.ring_sign = np.where(_wrap(self.cells.phi[cells[nxt]] - self.cells.phi[cells[first]]) < 0, -1, 1)
+        self.ring_phi0 = self.cells.phi[cells[first]] - self.ring_sign*self.cells.nphi[cells[first]]*pitch
+
+    @property
+    def shape(self):
+        # (channels, eta, phi, depth) of the image of one event
+        if self.window is None:
+            return (len(self.channels), len(self.rings), int(self.ring_nphi.max()), len(self.depths))
+        return (len(self.channels), 2*self.window[0] + 1, 2*self.window[1] + 1, len(self.depths))
+
+    def locate(self, cellID, hit_offsets, theta=None, phi=None):
+        # (hits, event, eta, phi, depth) voxels of the hits inside the image: hits indexes the input hits
+        N_events = len(hit_offsets) - 1
+        event    = np.repeat(np.arange(N_events), np.diff(hit_offsets))
+        dense    = self.cells.index(cellID)
+        keep     = np.flatnonzero((dense >= 0) & (self._cell_ring[np.maximum(dense, 0)] >= 0))
+        dense, event = dense[keep], event[keep]
+        ring, depth  = self._cell_ring[dense], self._cell_depth[dense]
+
+        if self.window is None:
+            return keep, event, ring, self.cells.nphi[dense].astype('int64'), depth
+
+        if theta is None or phi is None:
+            raise ValueError("A window needs the theta and phi of the image centres, e.g. from primary_directions.")
+        theta, phi = np.asarray(theta, dtype='float64'), np.asarray(phi, dtype='float64')
+        valid      = np.isfinite(theta) & np.isfinite(phi)
+        centre     = np.argmin(np.abs(self.ring_theta[None, :] - np.where(valid, theta, 0)[:, None]), axis=1)
+        # events without a centre (e.g. no primary particle) are not located, their images stay empty
+        located    = valid[event]
+        keep, event, dense, ring, depth = keep[located], event[located], dense[located], ring[located], depth[located]
+        # crystal of each ring closest to the centre azimuth, and the crystal offsets from it within the ring
+        n          = self.ring_nphi[ring]
+        sign       = self.ring_sign[ring]
+        nearest    = np.floor(sign*_wrap(phi[event] - self.ring_phi0[ring])*n/(2*np.pi) + 0.5).astype('int64')
+        eta_rel    = ring - centre[event]
+        phi_rel    = sign*((self.cells.nphi[dense] - nearest + n//2) % n - n//2)
+        inside     = (np.abs(eta_rel) <= self.window[0]) & (np.abs(phi_rel) <= self.window[1])
+        return (keep[inside], event[inside], eta_rel[inside] + self.window[0],
+                phi_rel[inside] + self.window[1], depth[inside])
+
+    def _columns(self, hits):
+        return hits.columns if isinstance(hits, HitCollection) else hits
+
+    def coo(self, hits, hit_offsets=None, theta=None, phi=None):
+        # Sparse images: dict of 'event', 'eta', 'phi', 'depth' voxel indices, 'values' (nnz, channels)
+        # summed per voxel, and the dense 'shape' (events, channels, eta, phi, depth)
+        columns = self._columns(hits)
+        if hit_offsets is None:
+            hit_offsets = np.array([0, len(columns['cellID'])])
+        index, *voxel = self.locate(columns['cellID'], hit_offsets, theta, phi)
+        _, n_eta, n_phi, n_depth = self.shape
+        flat    = ((voxel[0]*n_eta + voxel[1])*n_phi + voxel[2])*n_depth + voxel[3]
+        order   = np.argsort(flat, kind='stable')
+        flat    = flat[order]
+        starts  = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]]) if len(flat) else np.zeros(0, dtype='int64')
+        values  = np.stack([np.add.reduceat(np.asarray(columns[c], dtype='float64')[index[order]], starts)
+                            if len(starts) else np.zeros(0) for c in self.channels], axis=1).astype('float32')
+        flat    = flat[starts]
+        coo     = {'shape': (len(hit_offsets) - 1,) + self.shape, 'values': values}
+        for name, size in (('depth', n_depth), ('phi', n_phi), ('eta', n_eta)):
+            coo[name] = flat % size
+            flat      = flat // size
+        coo['event'] = flat
+        return coo
+
+    def dense(self, hits, hit_offsets=None, theta=None, phi=None):
+        # Dense images (events, channels, eta, phi, depth), float32
+        coo = self.coo(hits, hit_offsets, theta, phi)
+        out = np.zeros(coo['shape'], dtype='float32')
+        for c in range(len(self.channels)):
+            out[coo['event'], c, coo['eta'], coo['phi'], coo['depth']] = coo['values'][:, c]
+        return out
+
+    def export_chunk(self, chunk, sparse=False):
+        # Images of a chunk of the readers in scepcal_utils, centred on the primary MC particles when
+        # there is a window (the chunk then needs the generatorStatus, px, py, pz MC columns)
+        theta = phi = None
+        if self.window is not None:
+            theta, phi = primary_directions(chunk['mc_offsets'], chunk['mc'])
+        export = self.coo if sparse else self.dense
+        return export(chunk['hits'], chunk['hit_offsets'], theta, phi)
@@ -1,19 +1,194 @@
+import os
+import glob
 import h5py
 import numpy as np
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from math import atan2, atan, acos, asin, sqrt, sin, cos, tan, floor, ceil
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+
+try:
+    import hdf5plugin  # registers the LZ4/Zstd/Blosc filters for files converted with those codecs
+except ImportError:
+    hdf5plugin = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pads
+except ImportError:
+    pa = None
+
+DEFAULT_READOUT_ID = 'system:4,eta:11,phi:11,depth:4'
+
+class CellIDDecoder():
+    # Vectorized equivalent of the DD4hep BitFieldCoder for a readout <id> string,
+    # e.g. 'system:4,eta:11,phi:11,depth:4'. A field is name:width or name:offset:width,
+    # a negative width marks a signed field.
+    def __init__(self, spec=DEFAULT_READOUT_ID):
+        self.spec   = spec
+        self.fields = {}
+        offset = 0
+        for field in spec.split(','):
+            parts = [p.strip() for p in field.split(':')]
+            if len(parts) == 2:
+                name, width = parts[0], int(parts[1])
+            elif len(parts) == 3:
+                name, offset, width = parts[0], int(parts[1]), int(parts[2])
+            else:
+                raise ValueError(f"Invalid field '{field}' in readout id '{spec}'.")
+            signed = width < 0
+            width  = abs(width)
+            if width == 0 or offset < 0 or offset + width > 64:
+                raise ValueError(f"Field '{name}' does not fit in 64 bits in readout id '{spec}'.")
+            if name in self.fields:
+                raise ValueError(f"Duplicate field '{name}' in readout id '{spec}'.")
+            self.fields[name] = (offset, width, signed)
+            offset += width
+
+    @classmethod
+    def from_compact(cls, compactfile, readout='SCEPCal_readout'):
+        import xml.etree.ElementTree as ET
+        root = ET.parse(compactfile).getroot()
+        for ro in root.iter('readout'):
+            if ro.get('name') == readout:
+                return cls(ro.find('id').text.strip())
+        raise KeyError(f"Readout '{readout}' not found in '{compactfile}'.")
+
+    def __repr__(self):
+        return f"CellIDDecoder('{self.spec}')"
+
+    def get(self, cellID, name):
+        offset, width, signed = self.fields[name]
+        cellID = np.asarray(cellID, dtype='uint64')
+        value  = (cellID >> np.uint64(offset)) & np.uint64((1 << width) - 1)
+        if not signed and width == 64:
+            return int(value) if value.ndim == 0 else value
+        # sign extension in int64 (a 64-bit field wraps there already), then narrowed
+        value = value.astype('int64')
+        if signed and width < 64:
+            value = np.where(value >= (1 << (width-1)), value - (1 << width), value)
+        value = value.astype('int32' if width < 32 or (signed and width == 32) else 'int64')
+        return int(value) if value.ndim == 0 else value
+
+    def decode(self, cellID):
+        return {name: self.get(cellID, name) for name in self.fields}
+
+    def encode(self, **values):
+        missing = set(self.fields) - set(values)
+        if missing:
+            raise ValueError(f"Missing fields {sorted(missing)} for readout id '{self.spec}'.")
+        cellID = np.uint64(0)
+        for name, (offset, width, signed) in self.fields.items():
+            value  = np.asarray(values[name])
+            # masked in uint64: negative values wrap to two's complement, and a 64-bit mask fits
+            value  = (value if value.dtype.kind == 'u' else value.astype('int64')).astype('uint64') & np.uint64((1 << width) - 1)
+            cellID = cellID | (value << np.uint64(offset))
+        return int(cellID) if np.ndim(cellID) == 0 else cellID
+
+DEFAULT_DECODER = CellIDDecoder()
+
+# HitCollection attributes filled from the readout id fields
+CELLID_FIELD_ATTRS = {
+    'system': 'system',
+    'eta':    'neta',
+    'phi':    'nphi',
+    'depth':  'ndepth',
+}
 
 def getsystem(cellID):
-    return cellID & 0b1111   # system last 4 bits
+    return DEFAULT_DECODER.get(cellID, 'system')
 
 def geteta(cellID):
-    return (cellID>>4) & 0b11111111111    # eta preceding 11 bits
+    return DEFAULT_DECODER.get(cellID, 'eta')
 
 def getphi(cellID):
-    return (cellID>>15) & 0b11111111111     # phi preceding 11 bits
+    return DEFAULT_DECODER.get(cellID, 'phi')
 
 def getdepth(cellID):
-    return (cellID>>26) & 0b1111            # depth preceding 4 bits
+    return DEFAULT_DECODER.get(cellID, 'depth')
+
+# On-disk layout of the hdf5 files written by convertROOT2HDF5.py
+#   version 1: one Events/Event_N/{HitCollection,MCCollection} group per event
+#   version 2: one dataset per field across all events, delimited by event_offsets
+LAYOUT_VERSION = 2
+
+HIT_ATTRS = {
+    'cellID':             'uint64',
+    'E':                  'float32',
+    'x':                  'float32',
+    'y':                  'float32',
+    'z':                  'float32',
+    'system':             'int32',
+    'neta':               'int32',
+    'nphi':               'int32',
+    'ndepth':             'int32',
+    'ncerenkovprod':      'int32',
+    'nscintillationprod': 'int32',
+    'tavgc':              'float32',
+    'tavgs':              'float32',
+    'r':                  'float32',
+    'theta':              'float32',
+    'phi':                'float32',
+}
+
+MC_ATTRS = {
+    'PDG':             'int32',
+    'generatorStatus': 'int32',
+    'simulatorStatus': 'int32',
+    'charge':          'float32',
+    'time':            'float32',
+    'mass':            'float64',
+    'vx':              'float64',
+    'vy':              'float64',
+    'vz':              'float64',
+    'endx':            'float64',
+    'endy':            'float64',
+    'endz':            'float64',
+    'px':              'float32',
+    'py':              'float32',
+    'pz':              'float32',
+    'endpx':           'float32',
+    'endpy':           'float32',
+    'endpz':           'float32',
+    'spinx':           'float32',
+    'spiny':           'float32',
+    'spinz':           'float32',
+    'colorFlowa':      'int32',
+    'colorFlowb':      'int32',
+}
+
+# Hit fields that can be recomputed from stored ones: the readout id fields from cellID, and r, theta, phi
+# from x, y, z. Files converted with --no-derived leave them out, and HitCollection computes them on access.
+DERIVED_HIT_SOURCES = {
+    'system': ('cellID',),
+    'neta':   ('cellID',),
+    'nphi':   ('cellID',),
+    'ndepth': ('cellID',),
+    'r':      ('x', 'y', 'z'),
+    'theta':  ('x', 'y', 'z'),
+    'phi':    ('x', 'y', 'z'),
+}
+
+def derive_hit_columns(columns, attrs, decoder=DEFAULT_DECODER):
+    # Vectorized derived fields attrs of the hit columns, with the same dtypes and values as RawHit
+    derived = {}
+    fields  = {attr: field for field, attr in CELLID_FIELD_ATTRS.items()}
+    for attr in attrs:
+        if attr in fields:
+            cellID = columns['cellID']
+            if fields[attr] in decoder.fields:
+                derived[attr] = decoder.get(cellID, fields[attr]).astype(HIT_ATTRS[attr])
+            else:
+                derived[attr] = np.zeros(len(cellID), dtype=HIT_ATTRS[attr])
+
+    if any(attr in ('r', 'theta', 'phi') for attr in attrs):
+        x, y, z = (np.asarray(columns[c], dtype='float64') for c in ('x', 'y', 'z'))
+        r = np.sqrt(x*x + y*y + z*z)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            theta = np.where(r != 0, np.arccos(z/r), 0.)
+        spherical = {'r': r, 'theta': theta, 'phi': np.arctan2(y, x)}
+        derived.update({attr: spherical[attr].astype(HIT_ATTRS[attr]) for attr in attrs if attr in spherical})
+    return derived
 
 class MCParticle():
     def __init__(self, mcp):
@@ -42,37 +217,135 @@ class MCParticle():
         self.colorFlowb         = mcp.colorFlow.b
         self.energy             = sqrt(self.px*self.px +self.py*self.py +self.pz*self.pz +self.mass*self.mass)
 
-class MCCollection():
-    def __init__(self, mcplist):
-        self.particles           = np.array(mcplist)
-        self.N                   = len(mcplist)
-        self.PDG                 = np.array([mcp.PDG                 for mcp in self.particles])
-        self.generatorStatus     = np.array([mcp.generatorStatus     for mcp in self.particles])
-        self.simulatorStatus     = np.array([mcp.simulatorStatus     for mcp in self.particles])
-        self.charge              = np.array([mcp.charge              for mcp in self.particles])
-        self.time                = np.array([mcp.time                for mcp in self.particles])
-        self.mass                = np.array([mcp.mass                for mcp in self.particles])
-        self.vx                  = np.array([mcp.vx                  for mcp in self.particles])
-        self.vy                  = np.array([mcp.vy                  for mcp in self.particles])
-        self.vz                  = np.array([mcp.vz                  for mcp in self.particles])
-        self.endx                = np.array([mcp.endx                for mcp in self.particles])
-        self.endy                = np.array([mcp.endy                for mcp in self.particles])
-        self.endz                = np.array([mcp.endz                for mcp in self.particles])
-        self.px                  = np.array([mcp.px                  for mcp in self.particles])
-        self.py                  = np.array([mcp.py                  for mcp in self.particles])
-        self.pz                  = np.array([mcp.pz                  for mcp in self.particles])
-        self.endpx               = np.array([mcp.endpx               for mcp in self.particles])
-        self.endpy               = np.array([mcp.endpy               for mcp in self.particles])
-        self.endpz               = np.array([mcp.endpz               for mcp in self.particles])
-        self.spinx               = np.array([mcp.spinx               for mcp in self.particles])
-        self.spiny               = np.array([mcp.spiny               for mcp in self.particles])
-        self.spinz               = np.array([mcp.spinz               for mcp in self.particles])
-        self.colorFlowa          = np.array([mcp.colorFlowa          for mcp in self.particles])
-        self.colorFlowb          = np.array([mcp.colorFlowb          for mcp in self.particles])
-        self.energy              = np.array([mcp.energy              for mcp in self.particles])
+class _RowView():
+    # One hit or particle of a collection, reading its fields from the collection's columns
+    __slots__ = ('_coll', '_index')
+
+    def __init__(self, coll, index):
+        self._coll  = coll
+        self._index = index
+
+    def __getattr__(self, attr):
+        # private names are never fields; this also keeps copy/pickle from recursing before _coll is set
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        column = getattr(self._coll, attr)
+        if not isinstance(column, np.ndarray):
+            raise AttributeError(attr)
+        return column[self._index]
+
+    def __repr__(self):
+        fields = ', '.join(f'{attr}={getattr(self, attr)}' for attr in self._coll._attrs)
+        return f'{type(self).__name__}({fields})'
+
+class HitView(_RowView):
+    __slots__ = ()
+
+class MCParticleView(_RowView):
+    __slots__ = ()
+
+class _ColumnCollection():
+    # Struct of arrays: one numpy array per field, N entries each. Built from a list of
+    # hit/particle objects, or without any per-entry object through from_columns.
+    _schema     = {}
+    _view_class = _RowView
+
+    def __init__(self, items=()):
+        items = list(items)
+        views = [item for item in items if isinstance(item, self._view_class)]
+        if items and len(views) == len(items) and all(view._coll is views[0]._coll for view in views):
+            # views into one collection, e.g. [h for h in SDhits if ...]: gather instead of rebuilding
+            # through the parent's _like, so settings such as the decoder are kept
+            parent  = views[0]._coll
+            index   = np.array([view._index for view in views], dtype='int64')
+            self.__dict__.update(parent._like({attr: getattr(parent, attr)[index] for attr in parent._attrs}, len(index)).__dict__)
+            return
+        columns = {attr: np.array([getattr(item, attr) for item in items]) if items else np.zeros(0, dtype=dtype)
+                   for attr, dtype in self._schema.items()}
+        self._set_columns(columns)
+
+    def _set_columns(self, columns, N=None):
+        self._attrs = tuple(columns)
+        if N is None:
+            N = len(next(iter(columns.values()))) if columns else 0
+        self.N      = N
+        self.__dict__.update(columns)
+
+    @classmethod
+    def from_columns(cls, columns, N=None):
+        # N only needs to be given when columns is empty, e.g. after a column projection
+        coll = cls.__new__(cls)
+        coll._set_columns(dict(columns), N)
+        return coll
+
+    @property
+    def columns(self):
+        return {attr: getattr(self, attr) for attr in self._attrs}
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, attr).nbytes for attr in self._attrs)
+
+    def __len__(self):
+        return self.N
+
+    def __getitem__(self, key):
+        # coll[i] is a view of one entry; a mask, index array or slice gives a new collection
+        if isinstance(key, (int, np.integer)):
+            index = key + self.N if key < 0 else key
+            if not 0 <= index < self.N:
+                raise IndexError(f"Index {key} out of range for {self.N} entries.")
+            return self._view_class(self, int(index))
+        if not isinstance(key, slice):
+            key = np.asarray(key)
+            if key.size == 0 and key.dtype != bool:
+                # coll[[]]: an empty list is float64, which cannot index
+                key = key.astype(np.intp)
+        N = len(range(self.N)[key]) if isinstance(key, slice) else int(key.sum()) if key.dtype == bool else len(key)
+        return self._like({attr: getattr(self, attr)[key] for attr in self._attrs}, N)
+
+    def _like(self, columns, N=None):
+        # New collection of the same kind as self with other columns
+        return self.from_columns(columns, N)
+
+    def select(self, **criteria):
+        # coll.select(system=4, ndepth=[1, 2], E=lambda E: E > 0.01)
+        mask = np.ones(self.N, dtype=bool)
+        for attr, value in criteria.items():
+            column = getattr(self, attr)
+            if callable(value):
+                mask &= value(column)
+            elif isinstance(value, (list, tuple, set, np.ndarray)):
+                mask &= np.isin(column, list(value))
+            else:
+                mask &= column == value
+        return self[mask]
+
+    @classmethod
+    def concatenate(cls, colls):
+        colls = list(colls)
+        if not colls:
+            return cls()
+        attrs = [attr for attr in colls[0]._attrs if all(attr in coll._attrs for coll in colls)]
+        return colls[0]._like({attr: np.concatenate([getattr(coll, attr) for coll in colls]) for attr in attrs})
+
     def __iter__(self):
-        for mcp in self.particles:
-            yield mcp
+        for i in range(self.N):
+            yield self._view_class(self, i)
+
+class MCCollection(_ColumnCollection):
+    _schema     = MC_ATTRS
+    _view_class = MCParticleView
+
+    def _set_columns(self, columns, N=None):
+        if 'energy' not in columns and all(attr in columns for attr in ('px', 'py', 'pz', 'mass')):
+            px, py, pz, mass  = columns['px'], columns['py'], columns['pz'], columns['mass']
+            columns['energy'] = np.sqrt(px*px +py*py +pz*pz +mass*mass)
+        super()._set_columns(columns, N)
+
+    @property
+    def particles(self):
+        return np.array(list(self), dtype=object)
 
 class RawHit():
     # Takes edm4hep SimCalorimeterDRHit
@@ -95,208 +368,805 @@ class RawHit():
         self.phi                = atan2(self.y, self.x)
         # self.contribs = hit.contributions  # one-to-many relations not implemented in python classes
 
-class HitCollection():
-    # Takes python array of RawHit
-    def __init__(self, rawhits):
-        self.hits                = np.array(rawhits)
-        self.N                   = len(rawhits)
-        self.cellID              = np.array([hit.cellID              for hit in self.hits])
-        self.E                   = np.array([hit.E                   for hit in self.hits])
-        self.x                   = np.array([hit.x                   for hit in self.hits])
-        self.y                   = np.array([hit.y                   for hit in self.hits])
-        self.z                   = np.array([hit.z                   for hit in self.hits])
-        self.system              = np.array([hit.system              for hit in self.hits])
-        self.neta                = np.array([hit.neta                for hit in self.hits])
-        self.nphi                = np.array([hit.nphi                for hit in self.hits])
-        self.ndepth              = np.array([hit.ndepth              for hit in self.hits])
-        self.ncerenkovprod       = np.array([hit.ncerenkovprod       for hit in self.hits])
-        self.nscintillationprod  = np.array([hit.nscintillationprod  for hit in self.hits])
-        self.tavgc               = np.array([hit.tavgc               for hit in self.hits])
-        self.tavgs               = np.array([hit.tavgs               for hit in self.hits])
-        self.r                   = np.array([hit.r                      for hit in self.hits])
-        self.theta               = np.array([hit.theta                  for hit in self.hits])
-        self.phi                 = np.array([hit.phi                    for hit in self.hits])
+class AngularIndex():
+    # Directions (theta, phi) bucketed on a grid of cell x cell rad, sorted by bucket. Cone queries of
+    # many directions at once only look at the buckets that can overlap each cone. Angles are opening
+    # angles between directions, in rad. The default cell matches the mean spacing of the directions.
+    def __init__(self, theta, phi, cell=None):
+        theta, phi   = np.asarray(theta, dtype='float64'), np.asarray(phi, dtype='float64')
+        self.cell    = cell if cell is not None else float(np.clip(np.sqrt(4*np.pi/max(len(theta), 1)), 0.01, 0.5))
+        self.n_theta = int(np.ceil(np.pi/self.cell))
+        self.n_phi   = int(np.ceil(2*np.pi/self.cell))
+        self.N       = len(theta)
+        valid        = np.isfinite(theta) & np.isfinite(phi)
+        key          = np.where(valid, self._bucket(np.where(valid, theta, 0), np.where(valid, phi, 0)), self.n_theta*self.n_phi)
+        self.order   = np.argsort(key, kind='stable')
+        self.offsets = np.searchsorted(key[self.order], np.arange(self.n_theta*self.n_phi + 1))
+        self.unit    = _unit_vectors(theta, phi)[:, self.order]
+
+    @classmethod
+    def from_vectors(cls, x, y, z, cell=None):
+        x, y, z = (np.asarray(a, dtype='float64') for a in (x, y, z))
+        with np.errstate(invalid='ignore'):
+            return cls(np.arctan2(np.sqrt(x*x + y*y), np.where(x*x + y*y + z*z > 0, z, np.nan)), np.arctan2(y, x), cell)
+
+    def __len__(self):
+        return self.N
+
+    def _bucket(self, theta, phi):
+        it = np.clip((theta/self.cell).astype('int64'), 0, self.n_theta - 1)
+        ip = np.clip(((phi + np.pi)*self.n_phi/(2*np.pi)).astype('int64'), 0, self.n_phi - 1)
+        return it*self.n_phi + ip
+
+    def _candidates(self, theta, phi, radius):
+        # (query, point, cos angle) of the points within radius of each query direction
+        theta, phi, radius = np.broadcast_arrays(*(np.asarray(a, dtype='float64') for a in (theta, phi, radius)))
+        Q      = len(theta)
+        lo, hi = theta - radius, theta + radius
+        it_lo  = np.clip((np.maximum(lo, 0)/self.cell).astype('int64'), 0, self.n_theta - 1)
+        it_hi  = np.clip((np.minimum(hi, np.pi)/self.cell).astype('int64'), 0, self.n_theta - 1)
+        # widest azimuth of a cap that does not contain a pole: asin(sin(radius)/sin(theta))
+        pole   = (lo <= 0) | (hi >= np.pi) | (radius >= np.pi/2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dphi = np.where(pole, np.pi, np.arcsin(np.minimum(1, np.sin(radius)/np.sin(theta))))
+        width  = 2*np.pi/self.n_phi
+        ip_lo  = np.floor((phi - dphi + np.pi)/width).astype('int64')
+        n_ip   = np.minimum(np.floor((phi + dphi + np.pi)/width).astype('int64') - ip_lo + 1, self.n_phi)
+        n_it   = it_hi - it_lo + 1
+        valid  = np.isfinite(theta) & np.isfinite(phi)
+        n_bins = np.where(valid, n_it*n_ip, 0)
+
+        # every (query, bucket) pair, then every (query, point) pair in those buckets
+        q      = np.repeat(np.arange(Q), n_bins)
+        k      = np.arange(n_bins.sum()) - np.repeat(np.cumsum(n_bins) - n_bins, n_bins)
+        bucket = (it_lo[q] + k//n_ip[q])*self.n_phi + (ip_lo[q] + k % n_ip[q]) % self.n_phi
+        start  = self.offsets[bucket]
+        count  = self.offsets[bucket + 1] - start
+        q      = np.repeat(q, count)
+        point  = np.arange(count.sum()) + np.repeat(start - (np.cumsum(count) - count), count)
+        cos    = np.einsum('ij,ij->j', self.unit[:, point], _unit_vectors(theta[q], phi[q]))
+        keep   = cos >= np.cos(radius[q]) - 1e-12
+        return q[keep], point[keep], cos[keep]
+
+    def query_cone(self, theta, phi, radius):
+        # Points within radius of each direction, in CSR form: (offsets, indices) with the points of
+        # direction i in indices[offsets[i]:offsets[i+1]], sorted by bucket
+        theta   = np.atleast_1d(theta)
+        q, point, _ = self._candidates(theta, phi, radius)
+        offsets = np.zeros(len(theta) + 1, dtype='int64')
+        np.cumsum(np.bincount(q, minlength=len(theta)), out=offsets[1:])
+        return offsets, self.order[point]
+
+    def nearest(self, theta, phi, max_angle=np.pi):
+        # (index, angle) of the closest point to each direction, -1 and NaN if none is within max_angle.
+        # Cones grow from one grid cell until they hold a point: everything inside a cone was looked at.
+        theta, phi = (np.atleast_1d(np.asarray(a, dtype='float64')) for a in (theta, phi))
+        index      = np.full(len(theta), -1, dtype='int64')
+        angle      = np.full(len(theta), np.nan)
+        remaining  = np.flatnonzero(np.isfinite(theta) & np.isfinite(phi)) if self.N else np.zeros(0, dtype='int64')
+        radius     = min(self.cell, max_angle)
+        while len(remaining):
+            q, point, cos = self._candidates(theta[remaining], phi[remaining], radius)
+            best  = np.lexsort((-cos, q))
+            first = best[np.flatnonzero(np.r_[True, q[best][1:] != q[best][:-1]])] if len(q) else best
+            index[remaining[q[first]]] = self.order[point[first]]
+            angle[remaining[q[first]]] = np.arccos(np.clip(cos[first], -1, 1))
+            found = np.zeros(len(remaining), dtype=bool)
+            found[q[first]] = True
+            if radius >= max_angle:
+                break
+            remaining = remaining[~found]
+            radius    = min(2*radius, max_angle)
+        return index, angle
+
+def _unit_vectors(theta, phi):
+    sin_theta = np.sin(theta)
+    return np.array([sin_theta*np.cos(phi), sin_theta*np.sin(phi), np.cos(theta)])
+
+class HitCollection(_ColumnCollection):
+    # Takes python array of RawHit (or HitView), or columns through from_columns.
+    # Derived fields (DERIVED_HIT_SOURCES) missing from the columns are computed on first access with
+    # decoder (the file's cellID encoding when read from a file) and then kept as columns.
+    _schema     = HIT_ATTRS
+    _view_class = HitView
+    decoder     = DEFAULT_DECODER
+
+    @classmethod
+    def from_columns(cls, columns, N=None, decoder=None):
+        coll = super().from_columns(columns, N)
+        if decoder is not None:
+            coll.decoder = decoder
+        return coll
+
+    def _like(self, columns, N=None):
+        return self.from_columns(columns, N, self.decoder)
+
+    def __getattr__(self, attr):
+        sources = DERIVED_HIT_SOURCES.get(attr)
+        if sources is None or not all(src in self.__dict__ for src in sources):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attr}'")
+        self.__dict__[attr] = derive_hit_columns(self.__dict__, [attr], self.decoder)[attr]
+        self._attrs        += (attr,)
+        return self.__dict__[attr]
+
+    @property
+    def hits(self):
+        return np.array(list(self), dtype=object)
+
+    @property
+    def angular_index(self):
+        # AngularIndex of the hit directions seen from the origin, built on first use
+        if '_angular_index' not in self.__dict__:
+            self.__dict__['_angular_index'] = AngularIndex(self.theta, self.phi)
+        return self.__dict__['_angular_index']
+
+    def cone(self, theta, phi, radius):
+        # Hits within an opening angle radius of each direction: (offsets, hit indices) in CSR form
+        return self.angular_index.query_cone(theta, phi, radius)
+
+    def nearest_particle(self, mc, max_angle=np.pi):
+        # (index into mc, opening angle) of the particle whose momentum points closest to each hit,
+        # -1 and NaN when none is within max_angle, e.g. hits.nearest_particle(mc.select(generatorStatus=1))
+        particles = AngularIndex.from_vectors(mc.px, mc.py, mc.pz)
+        return particles.nearest(self.theta, self.phi, max_angle)
+
+# Hit fields added by Digitizer: detected photons and smeared arrival times (NaN without detected photons)
+DIGI_HIT_ATTRS = {
+    'ncerenkovdet':      'int32',
+    'nscintillationdet': 'int32',
+    'tdetc':             'float32',
+    'tdets':             'float32',
+}
+
+class Digitizer():
+    # Photostatistics and timing of the recorded photon counts. The produced photons of each hit are
+    # detected with an efficiency, by binomial thinning or as a Poisson count around the expected number
+    # (photostatistics='poisson'), then saturate a SiPM of sipm_pixels pixels (0: no saturation). Arrival
+    # times are smeared by time_resolution (+) time_stochastic/sqrt(detected photons), in ns. Efficiencies
+    # and pixel counts are scalars or arrays indexed by the system field.
+    # Each event draws from its own counter-based generator, Philox keyed by (seed, event number), so the
+    # result of an event does not depend on how events are batched, ordered or split between processes.
+    def __init__(self, scintillation_efficiency=1., cerenkov_efficiency=1., photostatistics='binomial',
+                 sipm_pixels=0, time_resolution=0., time_stochastic=0., seed=0, n_systems=16):
+        if photostatistics not in ('binomial', 'poisson'):
+            raise ValueError(f"Unknown photostatistics '{photostatistics}', use 'binomial' or 'poisson'.")
+        per_system = lambda value: np.broadcast_to(np.asarray(value, dtype='float64'), (n_systems,)).copy()
+        self.scintillation_efficiency = per_system(scintillation_efficiency)
+        self.cerenkov_efficiency      = per_system(cerenkov_efficiency)
+        self.sipm_pixels              = per_system(sipm_pixels)
+        self.photostatistics          = photostatistics
+        self.time_resolution          = time_resolution
+        self.time_stochastic          = time_stochastic
+        self.seed                     = int(seed)
+        if not 0 <= self.seed < 2**64:
+            raise ValueError(f"seed must be in [0, 2**64), got {seed}.")
+
+    def rng(self, event_number):
+        # the two 64-bit words of the Philox key, so every (seed, event number) pair has its own stream
+        event_number = int(event_number)
+        if not 0 <= event_number < 2**64:
+            raise ValueError(f"Event numbers must be in [0, 2**64), got {event_number}.")
+        return np.random.Generator(np.random.Philox(key=np.array([self.seed, event_number], dtype='uint64')))
+
+    def digitize(self, hits, event_number=0):
+        # HitCollection of one event with the DIGI_HIT_ATTRS columns added
+        columns = self.digitize_events(hits.columns, [0, len(hits)], [event_number], hits.decoder)
+        return hits._like({**hits.columns, **columns}, len(hits))
+
+    def digitize_chunk(self, chunk, decoder=None):
+        # Copy of a chunk of the readers above with the DIGI_HIT_ATTRS columns added to its hits
+        if decoder is None:
+            decoder = CellIDDecoder(chunk['cellID_encoding']) if 'cellID_encoding' in chunk else DEFAULT_DECODER
+        digi = self.digitize_events(chunk['hits'], chunk['hit_offsets'], chunk['event_numbers'], decoder)
+        return {**chunk, 'hits': {**chunk['hits'], **digi}}
+
+    def digitize_events(self, hits, hit_offsets, event_numbers, decoder=DEFAULT_DECODER):
+        # DIGI_HIT_ATTRS columns of the hit columns of several events delimited by hit_offsets
+        system  = hits['system'] if 'system' in hits else derive_hit_columns(hits, ['system'], decoder)['system']
+        offsets = np.asarray(hit_offsets, dtype='int64')
+        counts  = {}
+        for name, produced, efficiency in (('ncerenkovdet',      'ncerenkovprod',      self.cerenkov_efficiency),
+                                           ('nscintillationdet', 'nscintillationprod', self.scintillation_efficiency)):
+            counts[name] = (np.asarray(hits[produced], dtype='int64'), efficiency[system])
+        times   = [(time, avg, name) for time, avg, name in (('tdetc', 'tavgc', 'ncerenkovdet'), ('tdets', 'tavgs', 'nscintillationdet'))
+                   if avg in hits]
+
+        detected = {name: np.zeros(offsets[-1], dtype='int64') for name in counts}
+        noise    = {time: np.zeros(offsets[-1]) for time, _, _ in times}
+        for k, event_number in enumerate(event_numbers):
+            a, b = offsets[k], offsets[k+1]
+            rng  = self.rng(event_number)
+            # same draws whatever the time columns, so counts only depend on seed and event number
+            for name, (produced, efficiency) in counts.items():
+                if self.photostatistics == 'binomial':
+                    detected[name][a:b] = rng.binomial(produced[a:b], efficiency[a:b])
+                else:
+                    detected[name][a:b] = rng.poisson(produced[a:b]*efficiency[a:b])
+            for time, _, _ in times:
+                noise[time][a:b] = rng.standard_normal(b - a)
+
+        pixels = self.sipm_pixels[system]
+        for name, n in detected.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                saturated = np.rint(pixels*-np.expm1(-n/pixels))
+            detected[name] = np.where(pixels > 0, saturated, n)
+
+        out = {name: detected[name].astype(DIGI_HIT_ATTRS[name]) for name in detected}
+        for time, avg, name in times:
+            n = detected[name]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sigma     = np.sqrt(self.time_resolution**2 + self.time_stochastic**2/n)
+                out[time] = np.where(n > 0, np.asarray(hits[avg], dtype='float64') + sigma*noise[time], np.nan).astype(DIGI_HIT_ATTRS[time])
+        return out
+
+# Per-event summary written next to the columns, used to select events without reading any hits.
+# E_system has one column per value of the readout's system field.
+SUMMARY_ATTRS = {
+    'nhits':                    'int32',
+    'nmcparticles':             'int32',
+    'E_total':                  'float32',
+    'E_system':                 'float32',
+    'ncerenkovprod_total':      'int64',
+    'nscintillationprod_total': 'int64',
+    'n_primaries':              'int32',
+    'primary_PDG':              'int32',
+    'primary_px':               'float32',
+    'primary_py':               'float32',
+    'primary_pz':               'float32',
+    'primary_energy':           'float64',
+}
+
+def get_layout_version(f):
+    return int(f.attrs.get('layout_version', 1))
+
+def compute_event_summary(hit_offsets, hits, mc_offsets, mc, n_systems=16, decoder=DEFAULT_DECODER):
+    # Vectorized per-event sums over chunk columns; the primary is the first MC particle
+    # with generatorStatus==1 (PDG 0 and NaN kinematics if there is none)
+    N_events  = len(hit_offsets) - 1
+    hit_event = np.repeat(np.arange(N_events), np.diff(hit_offsets))
+    mc_event  = np.repeat(np.arange(N_events), np.diff(mc_offsets))
+    system    = hits['system'] if 'system' in hits else derive_hit_columns(hits, ['system'], decoder)['system']
+
+    summary = {
+        'nhits':                    np.diff(hit_offsets).astype('int32'),
+        'nmcparticles':             np.diff(mc_offsets).astype('int32'),
+        'E_total':                  np.bincount(hit_event, weights=hits['E'], minlength=N_events).astype('float32'),
+        'E_system':                 np.bincount(hit_event*n_systems + system, weights=hits['E'],
+                                                minlength=N_events*n_systems).reshape(N_events, n_systems).astype('float32'),
+        'ncerenkovprod_total':      np.bincount(hit_event, weights=hits['ncerenkovprod'], minlength=N_events).astype('int64'),
+        'nscintillationprod_total': np.bincount(hit_event, weights=hits['nscintillationprod'], minlength=N_events).astype('int64'),
+    }
+
+    primaries = np.flatnonzero(mc['generatorStatus'] == 1)
+    summary['n_primaries'] = np.bincount(mc_event[primaries], minlength=N_events).astype('int32')
+    events, first = np.unique(mc_event[primaries], return_index=True)
+    first = primaries[first]
+    for attr, fill in (('PDG', 0), ('px', np.nan), ('py', np.nan), ('pz', np.nan)):
+        column = np.full(N_events, fill, dtype=SUMMARY_ATTRS[f'primary_{attr}'])
+        column[events] = mc[attr][first]
+        summary[f'primary_{attr}'] = column
+    px, py, pz, mass = (mc[attr][first].astype('float64') for attr in ('px', 'py', 'pz', 'mass'))
+    summary['primary_energy'] = np.full(N_events, np.nan)
+    summary['primary_energy'][events] = np.sqrt(px*px + py*py + pz*pz + mass*mass)
+    return summary
+
+class EventSummary():
+    # Lazy view of the EventSummary group: each field is read in full on first access,
+    # as summary['E_total'] or summary.E_total
+    def __init__(self, grp):
+        self._grp    = grp
+        self._fields = {}
+
+    def keys(self):
+        return list(self._grp.keys())
+
+    def __len__(self):
+        return self._grp['nhits'].shape[0]
+
+    def __getitem__(self, name):
+        if name not in self._fields:
+            self._fields[name] = self._grp[name][:]
+        return self._fields[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+def load_event_summary(filename, fields=None):
+    with h5py.File(filename, 'r') as f:
+        if 'EventSummary' not in f:
+            raise KeyError(f"'{filename}' has no EventSummary, convert it again to add one.")
+        grp = f['EventSummary']
+        return {name: grp[name][:] for name in (fields if fields is not None else grp)}
+
+def _projected_columns(grp, requested, schema):
+    # Datasets of grp to read: the requested ones (all schema fields if None) that exist in the file,
+    # or the fields they are derived from if they do not
+    names   = schema if requested is None else requested
+    columns = []
+    for attr in names:
+        for name in ((attr,) if attr in grp else DERIVED_HIT_SOURCES.get(attr, ())):
+            if name != 'event_offsets' and name in grp and name not in columns:
+                columns.append(name)
+    return columns
+
+def memmap_dataset(dset):
+    # np.memmap over the bytes of a contiguous, uncompressed dataset (no copy, pages are read when
+    # touched); None if the dataset is chunked, compressed or virtual
+    if dset.is_virtual or dset.chunks is not None:
+        return None
+    if dset.size == 0:
+        return np.zeros(dset.shape, dtype=dset.dtype)
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(dset.file.filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+
+def map_hdf5_columns(f):
+    # Nested dict with the structure of a layout version 2 file, holding a memmap of every dataset that
+    # can be mapped and the h5py dataset otherwise. It can be used in place of the file in read_chunk_from_hdf5.
+    mapped, unmapped = {}, 0
+    for name, obj in f.items():
+        if isinstance(obj, h5py.Group):
+            mapped[name], n = map_hdf5_columns(obj)
+            unmapped += n
+        else:
+            mapped[name] = memmap_dataset(obj)
+            if mapped[name] is None:
+                mapped[name] = obj
+                unmapped += 1
+    if f.name != '/':
+        return mapped, unmapped
+    if unmapped:
+        print(f"Warning: {unmapped} datasets of '{f.filename}' are chunked, compressed or virtual and are read through h5py.")
+    return mapped
+
+def read_chunk_from_hdf5(f, start, stop, columns=None, mc_columns=None):
+    # Columns of events [start, stop) of a layout version 2 file, in the converter's chunk format
+    chunk = {'event_numbers': f['event_numbers'][start:stop]}
+    for grp_name, key, offsets_key, requested, attrs in (('HitCollection', 'hits', 'hit_offsets', columns,    HIT_ATTRS),
+                                                         ('MCCollection',  'mc',   'mc_offsets',  mc_columns, MC_ATTRS)):
+        grp     = f[grp_name]
+        offsets = grp['event_offsets'][start:stop+1]
+        chunk[key]         = {attr: grp[attr][offsets[0]:offsets[-1]] for attr in _projected_columns(grp, requested, attrs)}
+        chunk[offsets_key] = offsets - offsets[0]
+    return chunk
+
+def iter_chunks_from_hdf5(filename, chunk_events=1000, columns=None, mc_columns=None):
+    with h5py.File(filename, 'r') as f:
+        if get_layout_version(f) < 2:
+            raise ValueError(f"'{filename}' uses layout version 1, chunked reading needs layout version 2.")
+        N_events = f['event_numbers'].shape[0]
+        for start in range(0, N_events, chunk_events):
+            yield read_chunk_from_hdf5(f, start, min(start+chunk_events, N_events), columns, mc_columns)
+
+def _event_from_chunk(chunk, k, decoder=None):
+    # (HitCollection, MCCollection) of the k-th event of a chunk, as views of the chunk columns
+    ho, mo = chunk['hit_offsets'], chunk['mc_offsets']
+    hc     = HitCollection.from_columns({attr: col[ho[k]:ho[k+1]] for attr, col in chunk['hits'].items()}, ho[k+1]-ho[k], decoder)
+    mccoll = MCCollection.from_columns({attr: col[mo[k]:mo[k+1]] for attr, col in chunk['mc'].items()}, mo[k+1]-mo[k])
+    return hc, mccoll
+
+class JaggedHits():
+    # Hit columns of many events concatenated, the hits of event k at [offsets[k], offsets[k+1]), with
+    # grouped reductions over all of them at once, e.g.
+    #   groups, E = hits.sum('E', by=['event', 'system', 'ndepth'])
+    #   groups, i = hits.argmax('E', by='event')
+    # Keys and values are hit columns (derived fields are computed on first use), 'event' or arrays with
+    # one value per hit. The reductions return (groups, values): a dict with the key values of every group
+    # that has hits, in lexicographic order ('event' as event numbers), and one value per group. Grouping by
+    # 'event' alone gives every event, empty ones included (0 for sums and counts, NaN for means and
+    # extrema, -1 for argmax/argmin).
+    def __init__(self, columns, offsets, event_numbers=None, decoder=DEFAULT_DECODER):
+        self.columns       = dict(columns)
+        self.offsets       = np.asarray(offsets, dtype='int64')
+        self.event_numbers = np.arange(len(self.offsets) - 1) if event_numbers is None else np.asarray(event_numbers)
+        self.decoder       = decoder
+
+    @classmethod
+    def from_chunk(cls, chunk, decoder=None):
+        # A chunk of iter_chunks_from_hdf5/parquet, without copying its columns
+        if decoder is None:
+            decoder = CellIDDecoder(chunk['cellID_encoding']) if 'cellID_encoding' in chunk else DEFAULT_DECODER
+        return cls(chunk['hits'], chunk['hit_offsets'], chunk.get('event_numbers'), decoder)
+
+    @classmethod
+    def from_chunks(cls, chunks, decoder=None):
+        # All events of an iterable of chunks, e.g. a whole file read with only the columns needed
+        parts = [cls.from_chunk(chunk, decoder) for chunk in chunks]
+        if not parts:
+            return cls({}, [0], decoder=decoder or DEFAULT_DECODER)
+        sizes   = np.array([p.offsets[-1] for p in parts])
+        offsets = np.concatenate([[0]] + [p.offsets[1:] + start for p, start in zip(parts, np.cumsum(sizes) - sizes)])
+        columns = {attr: np.concatenate([p.columns[attr] for p in parts]) for attr in parts[0].columns}
+        return cls(columns, offsets, np.concatenate([p.event_numbers for p in parts]), parts[0].decoder)
+
+    @classmethod
+    def from_events(cls, events):
+        # The dict of HitCollections of load_allevents_from_hdf5/parquet, in event number order
+        numbers = sorted(events)
+        hcs     = [events[n] for n in numbers]
+        offsets = np.concatenate(([0], np.cumsum([len(hc) for hc in hcs], dtype='int64')))
+        attrs   = hcs[0].columns.keys() if hcs else ()
+        columns = {attr: np.concatenate([hc.columns[attr] for hc in hcs]) for attr in attrs}
+        return cls(columns, offsets, np.array(numbers, dtype='int64'), hcs[0].decoder if hcs else DEFAULT_DECODER)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nhits(self):
+        return int(self.offsets[-1])
+
+    def column(self, name):
+        # A hit column, 'event' (position of the event of every hit) or a derived field
+        if name == 'event':
+            return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        if name not in self.columns:
+            if name not in DERIVED_HIT_SOURCES:
+                raise KeyError(f"No hit column '{name}'.")
+            self.columns.update(derive_hit_columns(self.columns, [name], self.decoder))
+        return np.asarray(self.columns[name])
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def _values(self, values):
+        values = self.column(values) if isinstance(values, str) else np.asarray(values)
+        if len(values) != self.nhits:
+            raise ValueError(f"Expected one value per hit ({self.nhits}), got {len(values)}.")
+        return values
+
+    def group(self, by):
+        # (group of every hit, key values of every group) for the keys by; array keys are named by position
+        by = [by] if isinstance(by, (str, np.ndarray)) else list(by)
+        if len(by) == 1 and isinstance(by[0], str) and by[0] == 'event':
+            return self.column('event'), {'event': self.event_numbers}
+        keys = [self._values(name).astype('int64') for name in by]
+        by   = [name if isinstance(name, str) else k for k, name in enumerate(by)]
+        lo   = [int(k.min()) if k.size else 0 for k in keys]
+        span = [int(k.max()) - l + 1 if k.size else 1 for k, l in zip(keys, lo)]
+        size = int(np.prod(span, dtype=object))
+        if size < 2**62:
+            # one integer key per hit, mixed radix with the first key most significant
+            key = np.zeros(self.nhits, dtype='int64')
+            for k, l, s in zip(keys, lo, span):
+                key = key*s + (k - l)
+            if size <= 4*self.nhits + 2**20:
+                counts        = np.bincount(key, minlength=size)
+                present       = np.flatnonzero(counts)
+                rank          = np.zeros(size, dtype='int64')
+                rank[present] = np.arange(len(present))
+                index         = rank[key]
+            else:
+                present, index = np.unique(key, return_inverse=True)
+            values = []
+            for l, s in zip(lo[::-1], span[::-1]):
+                values.append(present % s + l)
+                present = present // s
+            values = values[::-1]
+        else:
+            present, index = np.unique(np.stack(keys, axis=1), axis=0, return_inverse=True)
+            values = list(present.T)
+        groups = dict(zip(by, values))
+        if 'event' in groups:
+            groups['event'] = self.event_numbers[groups['event']]
+        return index.reshape(-1), groups
+
+    def _segments(self, index, n):
+        # (order sorting the hits by group, or None if they already are, start of every group, non-empty groups)
+        order  = None if np.all(index[1:] >= index[:-1]) else np.argsort(index, kind='stable')
+        counts = np.bincount(index, minlength=n)
+        return order, np.cumsum(counts) - counts, counts > 0
+
+    @staticmethod
+    def _n_groups(groups):
+        return len(next(iter(groups.values())))
+
+    def count(self, by):
+        index, groups = self.group(by)
+        return groups, np.bincount(index, minlength=self._n_groups(groups))
+
+    def sum(self, values, by):
+        index, groups = self.group(by)
+        return groups, np.bincount(index, weights=self._values(values), minlength=self._n_groups(groups))
+
+    def mean(self, values, by, weights=None):
+        # Weighted with weights (a column or array) if given, e.g. photon-weighted times
+        index, groups = self.group(by)
+        n       = self._n_groups(groups)
+        values  = self._values(values).astype('float64')
+        weights = np.ones(self.nhits) if weights is None else self._values(weights).astype('float64')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return groups, np.bincount(index, weights=weights*values, minlength=n)/np.bincount(index, weights=weights, minlength=n)
+
+    def _extreme(self, values, by, reduce):
+        index, groups = self.group(by)
+        n        = self._n_groups(groups)
+        values   = self._values(values).astype('float64')
+        order, starts, nonempty = self._segments(index, n)
+        ordered  = values if order is None else values[order]
+        out      = np.full(n, np.nan)
+        if self.nhits:
+            out[nonempty] = reduce.reduceat(ordered, starts[nonempty])
+        return index, groups, order, starts, nonempty, ordered, out
+
+    def max(self, values, by):
+        # NaN values are ignored
+        _, groups, *_, out = self._extreme(values, by, np.fmax)
+        return groups, out
+
+    def min(self, values, by):
+        _, groups, *_, out = self._extreme(values, by, np.fmin)
+        return groups, out
+
+    def _arg(self, values, by, reduce):
+        # index of the first hit holding the extreme value of every group
+        index, groups, order, starts, nonempty, ordered, out = self._extreme(values, by, reduce)
+        positions = np.arange(self.nhits) if order is None else order
+        holds     = np.where(ordered == out[index if order is None else index[order]], positions, self.nhits)
+        arg       = np.full(len(out), -1, dtype='int64')
+        if self.nhits:
+            arg[nonempty] = np.minimum.reduceat(holds, starts[nonempty])
+        arg[arg == self.nhits] = -1
+        return groups, arg
+
+    def argmax(self, values, by):
+        # Index of the hit with the largest value in every group, into the columns of this store
+        return self._arg(values, by, np.fmax)
+
+    def argmin(self, values, by):
+        return self._arg(values, by, np.fmin)
+
+class EventStore():
+    # Reads events on demand from an open hdf5 file (layout version 1 or 2).
+    # store[i] returns (HitCollection, MCCollection) of the i-th event; decoded events are kept
+    # in an LRU cache bounded by cache_events and cache_bytes (set either to 0 to disable it).
+    # columns/mc_columns restrict which datasets are read (None: all); requested fields missing
+    # from the file are left out of the collections. selection is a predicate on the EventSummary,
+    # e.g. lambda s: s.E_total > 5, returning a mask or indices of the events to keep; it is
+    # evaluated before any hit is read, and the store then only contains the selected events.
+    # memmap=True reads the datasets of a file converted with --contiguous through np.memmap, so that
+    # the collections are views of the page cache; it implies cache_events=0.
+    def __init__(self, filename, cache_events=128, cache_bytes=512*2**20, iter_chunk_events=1000,
+                 columns=None, mc_columns=None, selection=None, memmap=False):
+        self.filename          = filename
+        self.cache_events      = 0 if memmap else cache_events
+        self.cache_bytes       = cache_bytes
+        self.iter_chunk_events = iter_chunk_events
+        self.columns           = columns
+        self.mc_columns        = mc_columns
+        self._cache            = OrderedDict()
+        self._cached_bytes     = 0
+
+        self.f = h5py.File(filename, 'r')
+        self.layout_version = get_layout_version(self.f)
+        self.decoder        = CellIDDecoder(self.f.attrs.get('cellID_encoding', DEFAULT_READOUT_ID))
+        if self.layout_version == 1:
+            events = []
+            for event_name in self.f['Events']:
+                try:
+                    events.append((int(event_name.split('_')[1]), event_name))
+                except (IndexError, ValueError):
+                    print(f"Warning: Invalid event name format '{event_name}'. Skipping.")
+            events.sort()
+            self.event_numbers = np.array([num for num, _ in events], dtype='int64')
+            self._event_names  = [name for _, name in events]
+        elif self.layout_version == 2:
+            self._source       = map_hdf5_columns(self.f) if memmap else self.f
+            self.event_numbers = self._source['event_numbers'][:]
+            self._hit_offsets  = self._source['HitCollection']['event_offsets'][:]
+            self._mc_offsets   = self._source['MCCollection']['event_offsets'][:]
+            self._hit_attrs    = _projected_columns(self.f['HitCollection'], columns, HIT_ATTRS)
+            self._mc_attrs     = _projected_columns(self.f['MCCollection'], mc_columns, MC_ATTRS)
+        else:
+            self.f.close()
+            raise ValueError(f"Unsupported hdf5 layout version {self.layout_version} in '{filename}'.")
+
+        # positions in the file of the events in the store
+        self._positions = np.arange(len(self.event_numbers))
+        if selection is not None:
+            if self.summary is None:
+                self.f.close()
+                raise ValueError(f"'{filename}' has no EventSummary to evaluate the selection on.")
+            keep = np.asarray(selection(self.summary))
+            self._positions    = np.flatnonzero(keep) if keep.dtype == bool else np.sort(keep.astype('int64'))
+            self.event_numbers = self.event_numbers[self._positions]
+        self._index_of = {int(num): i for i, num in enumerate(self.event_numbers)}
+
+    @property
+    def summary(self):
+        # Summary of all events in the file (not only the selected ones), None if there is none
+        if 'EventSummary' not in self.f:
+            return None
+        if not hasattr(self, '_summary'):
+            self._summary = EventSummary(self.f['EventSummary'])
+        return self._summary
+
+    def __len__(self):
+        return len(self.event_numbers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+        self._source = None
+        self.f.close()
+
+    def _read_event(self, index):
+        index = self._positions[index]
+        if self.layout_version == 1:
+            event_grp = self.f['Events'][self._event_names[index]]
+            hits_grp, mc_grp = event_grp['HitCollection'], event_grp['MCCollection']
+            hit_attrs = _projected_columns(hits_grp, self.columns, HIT_ATTRS)
+            mc_attrs  = _projected_columns(mc_grp, self.mc_columns, MC_ATTRS)
+            N_hits    = hits_grp[next(iter(hits_grp))].shape[0] if len(hits_grp) else 0
+            N_mcp     = mc_grp[next(iter(mc_grp))].shape[0] if len(mc_grp) else 0
+            h0, h1, m0, m1 = 0, N_hits, 0, N_mcp
+        else:
+            hits_grp, mc_grp = self._source['HitCollection'], self._source['MCCollection']
+            hit_attrs, mc_attrs = self._hit_attrs, self._mc_attrs
+            h0, h1 = self._hit_offsets[index], self._hit_offsets[index+1]
+            m0, m1 = self._mc_offsets[index], self._mc_offsets[index+1]
+        hc     = HitCollection.from_columns({attr: hits_grp[attr][h0:h1] for attr in hit_attrs}, h1-h0, self.decoder)
+        mccoll = MCCollection.from_columns({attr: mc_grp[attr][m0:m1] for attr in mc_attrs}, m1-m0)
+        return hc, mccoll
+
+    def _cache_put(self, index, event):
+        nbytes = event[0].nbytes + event[1].nbytes
+        if self.cache_events <= 0 or nbytes > self.cache_bytes:
+            return
+        self._cache[index] = (event, nbytes)
+        self._cached_bytes += nbytes
+        while len(self._cache) > self.cache_events or self._cached_bytes > self.cache_bytes:
+            _, (_, evicted_nbytes) = self._cache.popitem(last=False)
+            self._cached_bytes -= evicted_nbytes
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Event index {index} out of range for {len(self)} events.")
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index][0]
+        event = self._read_event(index)
+        self._cache_put(index, event)
+        return event
+
+    def event(self, event_num):
+        # Look up by event number rather than position
+        return self[self._index_of[int(event_num)]]
+
+    def hits(self, index):
+        return self[index][0]
+
+    def mc(self, index):
+        return self[index][1]
+
     def __iter__(self):
-        for hit in self.hits:
-            yield hit
+        # Sequential reads go through whole chunks of events and bypass the cache; with a selection,
+        # a chunk spans at most iter_chunk_events file positions and only selected events are yielded
+        if self.layout_version == 1:
+            for index in range(len(self)):
+                yield self._read_event(index)
+            return
+        positions = self._positions
+        i = 0
+        while i < len(positions):
+            start = positions[i]
+            j     = np.searchsorted(positions, start + self.iter_chunk_events)
+            stop  = positions[j-1] + 1
+            chunk = read_chunk_from_hdf5(self._source, start, stop, self._hit_attrs, self._mc_attrs)
+            for k in positions[i:j] - start:
+                yield _event_from_chunk(chunk, k, self.decoder)
+            i = j
 
-class RawHit_h5:
-    def __init__(self, hit):
-        self.cellID               = hit['cellID']
-        self.E                    = hit['E']
-        self.x                    = hit['x']
-        self.y                    = hit['y']
-        self.z                    = hit['z']
-        self.system               = hit['system']
-        self.neta                 = hit['neta']
-        self.nphi                 = hit['nphi']
-        self.ndepth               = hit['ndepth']
-        self.ncerenkovprod        = hit['ncerenkovprod']
-        self.nscintillationprod   = hit['nscintillationprod']
-        self.tavgc                = hit['tavgc']
-        self.tavgs                = hit['tavgs']
-        self.r                    = hit['r']
-        self.theta                = hit['theta']
-        self.phi                  = hit['phi']
-
-class MCParticle_h5:
-    def __init__(self, mcp):
-        self.PDG                = mcp['PDG']
-        self.generatorStatus    = mcp['generatorStatus']
-        self.simulatorStatus    = mcp['simulatorStatus']
-        self.charge             = mcp['charge']
-        self.time               = mcp['time']
-        self.mass               = mcp['mass']
-        self.vx                 = mcp['vx']
-        self.vy                 = mcp['vy']
-        self.vz                 = mcp['vz']
-        self.endx               = mcp['endx']
-        self.endy               = mcp['endy']
-        self.endz               = mcp['endz']
-        self.px                 = mcp['px']
-        self.py                 = mcp['py']
-        self.pz                 = mcp['pz']
-        self.endpx              = mcp['endpx']
-        self.endpy              = mcp['endpy']
-        self.endpz              = mcp['endpz']
-        self.spinx              = mcp['spinx']
-        self.spiny              = mcp['spiny']
-        self.spinz              = mcp['spinz']
-        self.colorFlowa         = mcp['colorFlowa']
-        self.colorFlowb         = mcp['colorFlowb']
-        self.energy             = sqrt(self.px*self.px +self.py*self.py +self.pz*self.pz +self.mass*self.mass)
+def load_event_from_hdf5(filename, index, columns=None, mc_columns=None):
+    with EventStore(filename, cache_events=0, columns=columns, mc_columns=mc_columns) as store:
+        return store[index]
 
-def load_allevents_from_hdf5(filename):
+def load_allevents_from_hdf5(filename, columns=None, mc_columns=None, selection=None):
+    # columns/mc_columns: names of the hit/MC fields to read (default: all), e.g.
+    # columns=['cellID', 'E', 'ncerenkovprod', 'nscintillationprod'], mc_columns=[]
+    # selection: predicate on the EventSummary, e.g. lambda s: (s.primary_PDG == 22) & (s.E_total > 5)
     SDhits_allevents = {}
     MCP_allevents = {}
 
-    with h5py.File(filename, 'r') as f:
-        events_grp = f['Events']
-        for event_name in events_grp:
-            event_grp = events_grp[event_name]
-            try:
-                event_num = int(event_name.split('_')[1])
-            except (IndexError, ValueError):
-                print(f"Warning: Invalid event name format '{event_name}'. Skipping.")
-                continue
+    with EventStore(filename, cache_events=0, columns=columns, mc_columns=mc_columns, selection=selection) as store:
+        for event_num, (hc, mccoll) in zip(store.event_numbers, store):
+            SDhits_allevents[int(event_num)] = hc
+            MCP_allevents[int(event_num)]    = mccoll
 
-            hits_grp = event_grp['HitCollection']
-            try:
-                cellID               = hits_grp['cellID'][:]
-                E                    = hits_grp['E'][:]
-                x                    = hits_grp['x'][:]
-                y                    = hits_grp['y'][:]
-                z                    = hits_grp['z'][:]
-                system               = hits_grp['system'][:]
-                neta                 = hits_grp['neta'][:]
-                nphi                 = hits_grp['nphi'][:]
-                ndepth               = hits_grp['ndepth'][:]
-                ncerenkovprod        = hits_grp['ncerenkovprod'][:]
-                nscintillationprod   = hits_grp['nscintillationprod'][:]
-                tavgc                = hits_grp['tavgc'][:]
-                tavgs                = hits_grp['tavgs'][:]
-                r                    = hits_grp['r'][:]
-                theta                = hits_grp['theta'][:]
-                phi                  = hits_grp['phi'][:]
-            except KeyError as e:
-                print(f"Error: Missing dataset {e} in HitCollection of event {event_num}. Skipping.")
-                continue
+    print(f"Successfully loaded {len(SDhits_allevents)} events from '{filename}'.")
+    return SDhits_allevents, MCP_allevents
 
-            rawhits = []
-            N_hits = cellID.shape[0]
-
-            for i in range(N_hits):
-                hit = {
-                    'cellID':             cellID[i],
-                    'E':                  E[i],
-                    'x':                  x[i],
-                    'y':                  y[i],
-                    'z':                  z[i],
-                    'system':             system[i],
-                    'neta':               neta[i],
-                    'nphi':               nphi[i],
-                    'ndepth':             ndepth[i],
-                    'ncerenkovprod':      ncerenkovprod[i],
-                    'nscintillationprod': nscintillationprod[i],
-                    'tavgc':              tavgc[i],
-                    'tavgs':              tavgs[i],
-                    'r':                  r[i],
-                    'theta':              theta[i],
-                    'phi':                phi[i]
-                }
-                rawhit = RawHit_h5(hit)
-                rawhits.append(rawhit)
-
-            hc = HitCollection(rawhits)
-
-            mc_grp = event_grp['MCCollection']
-            try:
-                PDG             = mc_grp['PDG'][:]
-                generatorStatus = mc_grp['generatorStatus'][:]
-                simulatorStatus = mc_grp['simulatorStatus'][:]
-                charge          = mc_grp['charge'][:]
-                time            = mc_grp['time'][:]
-                mass            = mc_grp['mass'][:]
-                vx              = mc_grp['vx'][:]
-                vy              = mc_grp['vy'][:]
-                vz              = mc_grp['vz'][:]
-                endx            = mc_grp['endx'][:]
-                endy            = mc_grp['endy'][:]
-                endz            = mc_grp['endz'][:]
-                px              = mc_grp['px'][:]
-                py              = mc_grp['py'][:]
-                pz              = mc_grp['pz'][:]
-                endpx           = mc_grp['endpx'][:]
-                endpy           = mc_grp['endpy'][:]
-                endpz           = mc_grp['endpz'][:]
-                spinx           = mc_grp['spinx'][:]
-                spiny           = mc_grp['spiny'][:]
-                spinz           = mc_grp['spinz'][:]
-                colorFlowa      = mc_grp['colorFlowa'][:]
-                colorFlowb      = mc_grp['colorFlowb'][:]
-            except KeyError as e:
-                print(f"Error: Missing dataset {e} in MCCollection of event {event_num}. Skipping.")
-                continue
+# Parquet files written by the converter (--format parquet) hold one row per event: 'event_number',
+# the 'EventSummary/<field>' scalars, and list columns 'HitCollection/<field>' and 'MCCollection/<field>'.
+
+def _list_column_values(column):
+    # Flat numpy values of a list column of a record batch (no copy for numeric columns)
+    offsets = column.offsets.to_numpy()
+    return column.values.to_numpy(zero_copy_only=False)[offsets[0]:offsets[-1]]
+
+def iter_chunks_from_parquet(filename, chunk_events=1000, columns=None, mc_columns=None, filter=None, row_groups=None):
+    # Chunks in the converter's format. filter is a pyarrow expression on the per-event columns, e.g.
+    # pyarrow.dataset.field('EventSummary/E_total') > 5, pushed down to skip whole row groups.
+    # row_groups: indices of the row groups to read (default: all)
+    if pa is None:
+        raise ImportError('pyarrow is needed to read parquet files.')
+    dataset = pads.dataset(filename, format='parquet')
+    names   = set(dataset.schema.names)
+    spec    = (dataset.schema.metadata or {}).get(b'cellID_encoding', DEFAULT_READOUT_ID.encode()).decode()
+    groups  = []
+    for grp_name, key, offsets_key, count, requested, attrs in (
+            ('HitCollection', 'hits', 'hit_offsets', 'nhits',        columns,    HIT_ATTRS),
+            ('MCCollection',  'mc',   'mc_offsets',  'nmcparticles', mc_columns, MC_ATTRS)):
+        present = {name.split('/', 1)[1] for name in names if name.startswith(grp_name + '/')}
+        groups.append((grp_name, key, offsets_key, f'EventSummary/{count}', _projected_columns(present, requested, attrs)))
+
+    read = ['event_number'] + [count for *_, count, _ in groups] + [f'{grp[0]}/{attr}' for grp in groups for attr in grp[4]]
+    if row_groups is None:
+        sources = [dataset]
+    else:
+        pieces  = [piece for fragment in dataset.get_fragments() for piece in fragment.split_by_row_group()]
+        sources = [pieces[k] for k in row_groups]
+    batches = (batch for source in sources for batch in source.to_batches(columns=read, filter=filter, batch_size=chunk_events))
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        chunk = {'event_numbers': batch.column('event_number').to_numpy(), 'cellID_encoding': spec}
+        for grp_name, key, offsets_key, count, attrs in groups:
+            counts             = batch.column(count).to_numpy()
+            chunk[offsets_key] = np.concatenate(([0], np.cumsum(counts, dtype='int64')))
+            chunk[key]         = {attr: _list_column_values(batch.column(f'{grp_name}/{attr}')) for attr in attrs}
+        yield chunk
+
+def load_event_summary_from_parquet(filename, fields=None, filter=None):
+    # Same as load_event_summary, plus 'event_number' since a filter can drop events
+    if pa is None:
+        raise ImportError('pyarrow is needed to read parquet files.')
+    dataset = pads.dataset(filename, format='parquet')
+    names   = [name.split('/', 1)[1] for name in dataset.schema.names if name.startswith('EventSummary/')]
+    names   = [name for name in names if fields is None or name in fields]
+    table   = dataset.to_table(columns=['event_number'] + [f'EventSummary/{name}' for name in names], filter=filter)
+    summary = {'event_number': table.column('event_number').to_numpy()}
+    for name in names:
+        column = table.column(f'EventSummary/{name}').combine_chunks()
+        if name == 'E_system':
+            summary[name] = column.flatten().to_numpy().reshape(len(column), column.type.list_size)
+        else:
+            summary[name] = column.to_numpy()
+    return summary
+
+def load_allevents_from_parquet(filename, columns=None, mc_columns=None, filter=None):
+    # Same output as load_allevents_from_hdf5; filter: see iter_chunks_from_parquet
+    SDhits_allevents = {}
+    MCP_allevents = {}
 
-            mcp_list = []
-            N_mcp = PDG.shape[0]
-            for i in range(N_mcp):
-                mcp = {
-                    'PDG':             PDG[i],
-                    'generatorStatus': generatorStatus[i],
-                    'simulatorStatus': simulatorStatus[i],
-                    'charge':          charge[i],
-                    'time':            time[i],
-                    'mass':            mass[i],
-                    'vx':              vx[i],
-                    'vy':              vy[i],
-                    'vz':              vz[i],
-                    'endx':            endx[i],
-                    'endy':            endy[i],
-                    'endz':            endz[i],
-                    'px':              px[i],
-                    'py':              py[i],
-                    'pz':              pz[i],
-                    'endpx':           endpx[i],
-                    'endpy':           endpy[i],
-                    'endpz':           endpz[i],
-                    'spinx':           spinx[i],
-                    'spiny':           spiny[i],
-                    'spinz':           spinz[i],
-                    'colorFlowa':      colorFlowa[i],
-                    'colorFlowb':      colorFlowb[i]
-                }
-                mcp_obj = MCParticle_h5(mcp)
-                mcp_list.append(mcp_obj)
-
-            mccoll = MCCollection(mcp_list)
-
-            SDhits_allevents[event_num] = hc
-            MCP_allevents[event_num] = mccoll
+    for chunk in iter_chunks_from_parquet(filename, columns=columns, mc_columns=mc_columns, filter=filter):
+        decoder = CellIDDecoder(chunk['cellID_encoding'])
+        for k, event_num in enumerate(chunk['event_numbers']):
+            SDhits_allevents[int(event_num)], MCP_allevents[int(event_num)] = _event_from_chunk(chunk, k, decoder)
 
     print(f"Successfully loaded {len(SDhits_allevents)} events from '{filename}'.")
     return SDhits_allevents, MCP_allevents
 
+def iter_chunks(filename, chunk_events=1000, columns=None, mc_columns=None):
+    # Chunks of an hdf5 (layout version 2) or parquet file written by the converter
+    if h5py.is_hdf5(filename):
+        return iter_chunks_from_hdf5(filename, chunk_events, columns, mc_columns)
+    return iter_chunks_from_parquet(filename, chunk_events, columns, mc_columns)
+
 def load_allevents_from_ROOT(filename):
     f = TFile.Open(filename)
 
@@ -311,3 +1181,392 @@ def load_allevents_from_ROOT(filename):
         MCParticlesForEvent[i] = MCCollection([MCParticle(mcp) for mcp in MClayer])
 
     return SDhitsForEvent, MCParticlesForEvent
+
+class Histogram():
+    # Fixed-binning histogram in any number of dimensions. Each axis is (nbins, lo, hi) or
+    # (nbins, lo, hi, name); every axis has an underflow and an overflow bin, and entries with a NaN
+    # coordinate are dropped. Histograms with the same axes add up with + and +=.
+    def __init__(self, *axes):
+        if not axes:
+            raise ValueError("A histogram needs at least one axis.")
+        self.nbins = tuple(int(axis[0]) for axis in axes)
+        self.lo    = tuple(float(axis[1]) for axis in axes)
+        self.hi    = tuple(float(axis[2]) for axis in axes)
+        self.names = tuple(str(axis[3]) if len(axis) > 3 else '' for axis in axes)
+        if any(n < 1 for n in self.nbins) or any(hi <= lo for lo, hi in zip(self.lo, self.hi)):
+            raise ValueError(f"Invalid axes {axes}: need nbins >= 1 and hi > lo.")
+        self.sumw  = np.zeros([n + 2 for n in self.nbins])
+        self.sumw2 = np.zeros_like(self.sumw)
+
+    @property
+    def axes(self):
+        return tuple(zip(self.nbins, self.lo, self.hi, self.names))
+
+    @property
+    def ndim(self):
+        return len(self.nbins)
+
+    def __repr__(self):
+        return f"Histogram{self.axes}"
+
+    def empty_like(self):
+        return Histogram(*self.axes)
+
+    def copy(self):
+        h = self.empty_like()
+        h.sumw[...]  = self.sumw
+        h.sumw2[...] = self.sumw2
+        return h
+
+    def fill(self, *values, weights=None):
+        # One array per axis (or scalars), weights default to 1
+        if len(values) != self.ndim:
+            raise ValueError(f"Expected {self.ndim} coordinate arrays, got {len(values)}.")
+        values = np.broadcast_arrays(*(np.asarray(v, dtype='float64') for v in values))
+        keep   = np.ones(values[0].shape, dtype=bool)
+        for v in values:
+            keep &= ~np.isnan(v)
+        flat = np.zeros(int(keep.sum()), dtype='int64')
+        for v, n, lo, hi in zip(values, self.nbins, self.lo, self.hi):
+            index = np.floor((v[keep] - lo)*(n/(hi - lo)))
+            flat  = flat*(n + 2) + (np.clip(index, -1, n) + 1).astype('int64')
+        size = self.sumw.size
+        if weights is None:
+            counts = np.bincount(flat, minlength=size)
+            self.sumw  += counts.reshape(self.sumw.shape)
+            self.sumw2 += counts.reshape(self.sumw.shape)
+        else:
+            w = np.broadcast_to(np.asarray(weights, dtype='float64'), keep.shape)[keep]
+            self.sumw  += np.bincount(flat, weights=w,   minlength=size).reshape(self.sumw.shape)
+            self.sumw2 += np.bincount(flat, weights=w*w, minlength=size).reshape(self.sumw.shape)
+        return self
+
+    def __iadd__(self, other):
+        if self.axes != other.axes:
+            raise ValueError(f"Cannot add histograms with different axes: {self.axes} and {other.axes}.")
+        self.sumw  += other.sumw
+        self.sumw2 += other.sumw2
+        return self
+
+    def __add__(self, other):
+        return self.copy().__iadd__(other)
+
+    def edges(self, axis=0):
+        return np.linspace(self.lo[axis], self.hi[axis], self.nbins[axis] + 1)
+
+    def centers(self, axis=0):
+        edges = self.edges(axis)
+        return 0.5*(edges[1:] + edges[:-1])
+
+    def _inner(self, array, flow):
+        return array if flow else array[tuple(slice(1, -1) for _ in self.nbins)]
+
+    def values(self, flow=False):
+        return self._inner(self.sumw, flow)
+
+    def variances(self, flow=False):
+        return self._inner(self.sumw2, flow)
+
+    def project(self, *axes):
+        # Histogram of the given axes, summed over the others (flow bins included)
+        others = tuple(k for k in range(self.ndim) if k not in axes)
+        order  = [sorted(axes).index(k) for k in axes]
+        h = Histogram(*(self.axes[k] for k in axes))
+        h.sumw[...]  = self.sumw.sum(axis=others).transpose(order)
+        h.sumw2[...] = self.sumw2.sum(axis=others).transpose(order)
+        return h
+
+    def save(self, grp):
+        # Into an h5py group
+        grp.create_dataset('sumw',  data=self.sumw)
+        grp.create_dataset('sumw2', data=self.sumw2)
+        grp.attrs['nbins'] = self.nbins
+        grp.attrs['lo']    = self.lo
+        grp.attrs['hi']    = self.hi
+        grp.attrs['names'] = list(self.names)
+
+    @classmethod
+    def load(cls, grp):
+        names = [n.decode() if isinstance(n, bytes) else str(n) for n in grp.attrs['names']]
+        h = cls(*zip(grp.attrs['nbins'], grp.attrs['lo'], grp.attrs['hi'], names))
+        h.sumw[...]  = grp['sumw'][:]
+        h.sumw2[...] = grp['sumw2'][:]
+        return h
+
+def save_histograms(filename, histograms):
+    # dict of name -> Histogram, one group per histogram
+    with h5py.File(filename, 'w') as f:
+        for name, h in histograms.items():
+            h.save(f.create_group(name))
+
+def load_histograms(filename):
+    with h5py.File(filename, 'r') as f:
+        return {name: Histogram.load(f[name]) for name in f}
+
+def merge_histograms(total, histograms):
+    # Adds a dict of histograms into total (in place), returns total
+    for name, h in histograms.items():
+        if name in total:
+            total[name] += h
+        else:
+            total[name] = h.copy()
+    return total
+
+def expand_files(patterns):
+    # File names or glob patterns (a single string or a list) to file names; order is kept, duplicates dropped
+    files = []
+    for pattern in ([patterns] if isinstance(patterns, str) else patterns):
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            print(f"Warning: No files match '{pattern}'.")
+        files.extend(m for m in matches if m not in files)
+    return files
+
+def _count_events(filename):
+    if h5py.is_hdf5(filename):
+        with h5py.File(filename, 'r') as f:
+            if get_layout_version(f) < 2:
+                raise ValueError(f"'{filename}' uses layout version 1, chunked reading needs layout version 2.")
+            return f['event_numbers'].shape[0]
+    if pa is None:
+        raise ImportError('pyarrow is needed to read parquet files.')
+    return pads.dataset(filename, format='parquet').count_rows()
+
+def _iter_chunk_range(filename, start, stop, chunk_events=1000, columns=None, mc_columns=None):
+    with h5py.File(filename, 'r') as f:
+        for first in range(start, stop, chunk_events):
+            yield read_chunk_from_hdf5(f, first, min(first + chunk_events, stop), columns, mc_columns)
+
+def _run_task(job):
+    # (result, events) of events [start, stop) of an hdf5 file, or of a whole parquet file (start is None)
+    filename, start, stop, analyze, merge, chunk_events, columns, mc_columns = job
+    if start is None:
+        chunks = iter_chunks_from_parquet(filename, chunk_events, columns, mc_columns)
+    else:
+        chunks = _iter_chunk_range(filename, start, stop, chunk_events, columns, mc_columns)
+    result, N_events = None, 0
+    for chunk in chunks:
+        result    = analyze(chunk) if N_events == 0 else merge(result, analyze(chunk))
+        N_events += len(chunk['event_numbers'])
+    return result, N_events
+
+def run_analysis(files, analyze, merge, chunk_events=1000, task_events=10000, columns=None, mc_columns=None,
+                 jobs=None, retries=2, ordered=True):
+    # Map-reduce over every event of files (names or glob patterns, hdf5 layout version 2 or parquet):
+    # analyze(chunk) -> partial result for each chunk of the readers above, merge(a, b) -> combined result
+    # (it may update and return a). hdf5 files are split into tasks of task_events events and parquet files
+    # are one task each, run in a pool of jobs processes (in this process for jobs=1); analyze and merge
+    # must then be module-level functions. A failing task is retried up to retries times, after which its
+    # file is left out of the result with a warning. Returns None if no event was analyzed.
+    # ordered=True merges the partial results in file and event order, so the result does not depend on the
+    # scheduling; results that finish early wait for the earlier ones, and new tasks are only started while
+    # fewer than 4*jobs results are running or waiting. For a merge that does not depend on the order (e.g.
+    # histograms), ordered=False merges the results of a file as they finish and adds the file to the total
+    # as soon as it is done, so only one partial result per running file is held.
+    files = expand_files(files)
+    tasks, failed = [], []
+    for fname in files:
+        for attempt in range(retries + 1):
+            try:
+                N_events = _count_events(fname)
+                break
+            except Exception as e:
+                error = e
+        else:
+            print(f"Warning: Leaving out '{fname}', it cannot be read: {error}")
+            failed.append(fname)
+            continue
+        # (position of the task in its file, job of _run_task)
+        if h5py.is_hdf5(fname):
+            tasks.extend((k, (fname, start, min(start + task_events, N_events), analyze, merge, chunk_events, columns, mc_columns))
+                         for k, start in enumerate(range(0, N_events, task_events)))
+        elif N_events:
+            tasks.append((0, (fname, None, None, analyze, merge, chunk_events, columns, mc_columns)))
+    jobs = jobs or os.cpu_count()
+
+    def combine(a, b):
+        # (result, events) pairs, the result of a task without events is None
+        if not a[1]:
+            return b
+        if not b[1]:
+            return a
+        return merge(a[0], b[0]), a[1] + b[1]
+
+    # per file: number of tasks and finished tasks. If ordered, held[fname] is [the results of its tasks
+    # merged in task order so far, next task to merge, results that finished ahead of it]; waiting counts
+    # those results plus the finished files that wait for an earlier one. Otherwise held[fname] is the
+    # results merged so far.
+    counts = {fname: 0 for fname in files if fname not in failed}
+    for _, (fname, *_) in tasks:
+        counts[fname] += 1
+    done   = dict.fromkeys(counts, 0)
+    held   = {fname: [(None, 0), 0, {}] if ordered else (None, 0) for fname in counts}
+    order  = list(counts)
+    state  = {'total': (None, 0), 'next': 0, 'files': 0, 'waiting': 0}
+
+    def fold():
+        # ordered: adds the finished files at the front of order to the total
+        while state['next'] < len(order) and done[order[state['next']]] == counts[order[state['next']]]:
+            fname = order[state['next']]
+            state['total'] = combine(state['total'], held.pop(fname)[0])
+            if counts[fname]:
+                state['waiting'] -= 1
+            state['next'] += 1
+
+    def finish(task, result):
+        k, (fname, *_) = task
+        if fname in failed:
+            return
+        done[fname] += 1
+        if ordered:
+            merged, nxt, ahead = held[fname]
+            ahead[k] = result
+            state['waiting'] += 1
+            while nxt in ahead:
+                merged = combine(merged, ahead.pop(nxt))
+                nxt   += 1
+                state['waiting'] -= 1
+            held[fname] = [merged, nxt, ahead]
+        else:
+            held[fname] = combine(held[fname], result)
+        if done[fname] == counts[fname]:
+            state['files'] += 1
+            print(f'[{state["files"]}/{len(order)}] {fname}: {held[fname][0][1] if ordered else held[fname][1]} events')
+            if ordered:
+                state['waiting'] += 1
+                fold()
+            else:
+                state['total'] = combine(state['total'], held.pop(fname))
+
+    def fail(task, e):
+        fname = task[1][0]
+        print(f"Warning: Leaving out '{fname}' after {retries + 1} failed attempts: {e}")
+        failed.append(fname)
+        if ordered:
+            state['waiting'] -= len(held.pop(fname)[2])
+            order.remove(fname)
+            fold()
+        else:
+            held.pop(fname)
+
+    fold()
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            if task[1][0] in failed:
+                continue
+            for attempt in range(retries + 1):
+                try:
+                    result = _run_task(task[1])
+                except Exception as e:
+                    if attempt == retries:
+                        fail(task, e)
+                    continue
+                finish(task, result)
+                break
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            queue   = iter(tasks)
+            futures = {}
+            while True:
+                # keep the pool busy, but bound the results in flight and waiting for earlier ones; with
+                # nothing in flight a task is always started, so the run cannot stall
+                while not futures or len(futures) + state['waiting'] < 4*jobs:
+                    task = next(queue, None)
+                    if task is None:
+                        break
+                    if task[1][0] not in failed:
+                        futures[pool.submit(_run_task, task[1])] = (task, 0)
+                if not futures:
+                    break
+                future = next(as_completed(futures))
+                task, attempt = futures.pop(future)
+                if task[1][0] in failed:
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if attempt < retries:
+                        futures[pool.submit(_run_task, task[1])] = (task, attempt + 1)
+                    else:
+                        fail(task, e)
+                    continue
+                finish(task, result)
+
+    if failed:
+        print(f"Warning: {len(failed)} of {len(files)} files were left out: {failed}")
+    return state['total'][0]
+
+def _fill_chunk(fill, histograms, chunk):
+    histograms = {name: h.empty_like() for name, h in histograms.items()}
+    fill(chunk, histograms)
+    return histograms
+
+def fill_histograms(files, fill, histograms, chunk_events=1000, columns=None, mc_columns=None, jobs=None):
+    # Fills histograms (dict of name -> Histogram, the binning templates) with fill(chunk, histograms) over
+    # every chunk of files through run_analysis; memory per worker is one chunk plus one set of histograms.
+    # fill must be a module-level function so it can be sent to the workers. Returns the merged histograms.
+    total = run_analysis(files, partial(_fill_chunk, fill, histograms), merge_histograms, chunk_events,
+                         columns=columns, mc_columns=mc_columns, jobs=jobs, ordered=False)
+    return merge_histograms({name: h.empty_like() for name, h in histograms.items()}, total or {})
+
+def _batch_units(filename, batch_events):
+    # Units read by one call of _read_unit: event ranges of batch_events events of an hdf5 file,
+    # row groups of a parquet file
+    if h5py.is_hdf5(filename):
+        N_events = _count_events(filename)
+        return [(filename, start, min(start + batch_events, N_events)) for start in range(0, N_events, batch_events)]
+    if pa is None:
+        raise ImportError('pyarrow is needed to read parquet files.')
+    n_groups = sum(fragment.num_row_groups for fragment in pads.dataset(filename, format='parquet').get_fragments())
+    return [(filename, k, None) for k in range(n_groups)]
+
+def _read_unit(job):
+    (filename, start, stop), batch_events, columns, mc_columns = job
+    if stop is None:
+        return list(iter_chunks_from_parquet(filename, batch_events, columns, mc_columns, row_groups=[start]))
+    with h5py.File(filename, 'r') as f:
+        return [read_chunk_from_hdf5(f, start, stop, columns, mc_columns)]
+
+def iter_batches(files, batch_events=256, columns=None, mc_columns=None, prefetch=4, workers=1, processes=False,
+                 shuffle=False, seed=0, ordered=True):
+    # Batches of batch_events events (chunks in the converter's format) of files (names or glob patterns,
+    # hdf5 layout version 2 or parquet), read and decoded by workers threads (or processes) while the
+    # caller works on the current batch. At most prefetch reads are queued ahead, which bounds memory.
+    # hdf5 files are read batch by batch and parquet files row group by row group (a row group gives one
+    # or more batches). shuffle randomizes the order of these reads with seed (pass e.g. seed + epoch
+    # for a new order every epoch); with ordered=False batches are yielded as soon as they are read
+    # instead of in that order.
+    if prefetch < 1 or workers < 1:
+        raise ValueError("prefetch and workers must be at least 1.")
+    units = []
+    for fname in expand_files(files):
+        try:
+            units.extend(_batch_units(fname, batch_events))
+        except Exception as e:
+            print(f"Warning: Leaving out '{fname}', it cannot be read: {e}")
+    if shuffle:
+        units = [units[k] for k in np.random.default_rng(seed).permutation(len(units))]
+
+    pool    = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=workers)
+    jobs    = iter([(unit, batch_events, columns, mc_columns) for unit in units])
+    pending = deque()
+    try:
+        while len(pending) < prefetch:
+            job = next(jobs, None)
+            if job is None:
+                break
+            pending.append(pool.submit(_read_unit, job))
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                pending.remove(future)
+            batches = future.result()
+            # refill before handing out the batches, so the next read overlaps with the caller's work
+            job = next(jobs, None)
+            if job is not None:
+                pending.append(pool.submit(_read_unit, job))
+            yield from batches
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)